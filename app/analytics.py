@@ -0,0 +1,155 @@
+"""
+Constrained analytics tool layer for the AI assistant.
+
+The model never writes SQL. It picks from a whitelist of dimensions,
+measures and filters, and each spec compiles to a parameterised
+aggregate over the full Ticket/Manager tables, executed read-only with a
+statement timeout. Only the small result tables go back into the prompt.
+"""
+from datetime import datetime
+from typing import Any, Dict, List
+
+from sqlalchemy import select, func, text, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Ticket, Manager
+
+MAX_GROUP_BY = 2
+MAX_ROWS = 50
+MAX_QUERIES = 3
+STATEMENT_TIMEOUT_MS = 5000
+
+DIMENSIONS = {
+    "ticket_type": Ticket.ticket_type,
+    "sentiment": Ticket.sentiment,
+    "language": Ticket.language,
+    "segment": Ticket.segment,
+    "office": Ticket.office_name,
+    "city": Ticket.city,
+    "priority": Ticket.priority,
+    "manager": Manager.full_name,
+    "manager_position": Manager.position,
+    "day": func.date_trunc("day", Ticket.processed_at),
+    "week": func.date_trunc("week", Ticket.processed_at),
+    "month": func.date_trunc("month", Ticket.processed_at),
+}
+NEEDS_MANAGER_JOIN = {"manager", "manager_position"}
+
+MEASURES = {
+    "count": func.count(Ticket.id),
+    "avg_priority": func.round(func.avg(Ticket.priority), 2),
+    "unassigned": func.count(case((Ticket.manager_id.is_(None), 1))),
+    "negative_share": func.round(
+        func.avg(case((Ticket.sentiment == "Негативный", 1.0), else_=0.0)), 3
+    ),
+}
+
+# Equality filters; values are bound parameters
+FILTERS = {k: DIMENSIONS[k] for k in (
+    "ticket_type", "sentiment", "language", "segment", "office", "city",
+    "priority", "manager",
+)}
+
+# Filter values arrive as JSON from the model; coerce them to the column type
+FILTER_TYPES = {"priority": int}
+
+CATALOG = {
+    "group_by": sorted(DIMENSIONS),
+    "measures": sorted(MEASURES),
+    "filters": sorted(FILTERS),
+    "date_range": "date_from / date_to в формате YYYY-MM-DD (по processed_at)",
+    "limit": f"<= {MAX_ROWS}",
+    "max_group_by": MAX_GROUP_BY,
+}
+
+
+class InvalidSpec(ValueError):
+    pass
+
+
+def _coerce_filter(name: str, value: Any):
+    if isinstance(value, (dict, list)) or value is None:
+        raise InvalidSpec(f"filter {name} must be a single value")
+    try:
+        return FILTER_TYPES.get(name, str)(value)
+    except (TypeError, ValueError):
+        raise InvalidSpec(f"filter {name} has an invalid value: {value!r}")
+
+
+def build_query(spec: Dict[str, Any]):
+    if not isinstance(spec, dict):
+        raise InvalidSpec("query spec must be an object")
+    group_by = spec.get("group_by") or []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    if not isinstance(group_by, list) or not all(isinstance(d, str) for d in group_by):
+        raise InvalidSpec("group_by must be a list of dimension names")
+    if len(group_by) > MAX_GROUP_BY:
+        raise InvalidSpec(f"at most {MAX_GROUP_BY} group_by dimensions")
+    unknown = [d for d in group_by if d not in DIMENSIONS]
+    if unknown:
+        raise InvalidSpec(f"unknown dimensions: {unknown}")
+
+    measure = spec.get("measure", "count")
+    if not isinstance(measure, str) or measure not in MEASURES:
+        raise InvalidSpec(f"unknown measure: {measure}")
+
+    filters = spec.get("filters") or {}
+    if not isinstance(filters, dict):
+        raise InvalidSpec("filters must be an object")
+    bad = [k for k in filters if k not in FILTERS]
+    if bad:
+        raise InvalidSpec(f"unknown filters: {bad}")
+    filters = {k: _coerce_filter(k, v) for k, v in filters.items()}
+
+    cols = [DIMENSIONS[d].label(d) for d in group_by]
+    q = select(*cols, MEASURES[measure].label(measure)).select_from(Ticket)
+    if NEEDS_MANAGER_JOIN & (set(group_by) | set(filters)):
+        q = q.join(Manager, Manager.id == Ticket.manager_id)
+
+    q = q.where(Ticket.processed_at.isnot(None))
+    for k, v in filters.items():
+        q = q.where(FILTERS[k] == v)
+    for key, op in (("date_from", "__ge__"), ("date_to", "__le__")):
+        if spec.get(key):
+            try:
+                bound = datetime.fromisoformat(str(spec[key]))
+            except ValueError:
+                raise InvalidSpec(f"{key} must be YYYY-MM-DD")
+            q = q.where(getattr(Ticket.processed_at, op)(bound))
+
+    if group_by:
+        q = q.group_by(*[DIMENSIONS[d] for d in group_by])
+        time_dims = [d for d in group_by if d in ("day", "week", "month")]
+        q = q.order_by(DIMENSIONS[time_dims[0]] if time_dims else MEASURES[measure].desc())
+    try:
+        limit = min(max(1, int(spec.get("limit") or MAX_ROWS)), MAX_ROWS)
+    except (TypeError, ValueError):
+        raise InvalidSpec("limit must be an integer")
+    return q.limit(limit), [*group_by, measure]
+
+
+async def run_queries(db: AsyncSession, specs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Execute up to MAX_QUERIES specs in one read-only, time-limited transaction."""
+    out = []
+    await db.execute(text("SET TRANSACTION READ ONLY"))
+    await db.execute(text(f"SET LOCAL statement_timeout = {int(STATEMENT_TIMEOUT_MS)}"))
+    try:
+        for spec in specs[:MAX_QUERIES]:
+            try:
+                q, columns = build_query(spec)
+            except (InvalidSpec, TypeError, ValueError) as e:
+                out.append({"spec": spec, "error": str(e)})
+                continue
+            rows = (await db.execute(q)).all()
+            out.append({
+                "spec": spec,
+                "columns": columns,
+                "rows": [
+                    [v.isoformat()[:10] if isinstance(v, datetime) else v for v in r]
+                    for r in rows
+                ],
+            })
+    finally:
+        await db.rollback()
+    return out
@@ -0,0 +1,93 @@
+"""
+Run-level budgets for POST /tickets/process.
+
+A RunBudget caps wall-clock time, LLM tokens and LLM calls for one run.
+Workers ask admit() before starting a ticket; once any cap is reached
+no new work is admitted, in-flight tickets drain, and the run returns
+partial counts together with the reason it stopped.
+
+max_calls counts provider calls, not tickets: admit() reserves a
+ticket's first call, and retries, cascade escalations and hedged
+duplicates each need reserve_call() through the ticket's CallGate.
+"""
+import threading
+import time
+from typing import Optional
+
+from app.llm import TokenUsage
+
+
+class CallGate:
+    """Per-ticket call_gate: the first call was reserved by admit(), later ones reserve their own."""
+
+    def __init__(self, budget: "RunBudget"):
+        self._budget = budget
+        self.first_unused = True
+
+    def __call__(self) -> bool:
+        if self.first_unused:
+            self.first_unused = False
+            return True
+        return self._budget.reserve_call()
+
+
+class RunBudget:
+    def __init__(
+        self,
+        max_seconds: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        max_calls: Optional[int] = None,
+    ):
+        self.started = time.monotonic()
+        self.deadline = self.started + max_seconds if max_seconds else None
+        self.max_tokens = max_tokens
+        self.max_calls = max_calls
+        self.usage = TokenUsage()
+        self.in_flight = 0
+        self.calls_reserved = 0
+        self._calls_lock = threading.Lock()   # reserve_call runs in executor threads
+        self.stopped_reason: Optional[str] = None
+
+    def exhausted(self) -> Optional[str]:
+        if self.stopped_reason:
+            return self.stopped_reason
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.stopped_reason = "max_seconds"
+        elif self.max_tokens is not None and self.usage.total_tokens >= self.max_tokens:
+            self.stopped_reason = "max_tokens"
+        # Admitted tickets have already reserved their first call
+        elif self.max_calls is not None and self.calls_reserved >= self.max_calls:
+            self.stopped_reason = "max_calls"
+        return self.stopped_reason
+
+    def admit(self) -> Optional[CallGate]:
+        """
+        Reserve one LLM-bound ticket and its first provider call. Returns the
+        ticket's call gate, or None once the budget is spent.
+        """
+        if self.exhausted():
+            return None
+        if not self.reserve_call():
+            self.stopped_reason = "max_calls"
+            return None
+        self.in_flight += 1
+        return CallGate(self)
+
+    def reserve_call(self) -> bool:
+        """Claim one provider call; False once max_calls calls have been made or claimed."""
+        with self._calls_lock:
+            if self.max_calls is not None and self.calls_reserved >= self.max_calls:
+                return False
+            self.calls_reserved += 1
+            return True
+
+    def release(self, gate: Optional[CallGate] = None):
+        """Finish an admitted ticket; a first call it never made goes back to the budget."""
+        self.in_flight = max(0, self.in_flight - 1)
+        if gate is not None and gate.first_unused:
+            gate.first_unused = False
+            with self._calls_lock:
+                self.calls_reserved -= 1
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
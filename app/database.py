@@ -1,9 +1,11 @@
 import os
+import time
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     AsyncSession,
     async_sessionmaker,
 )
+from sqlalchemy import text
 from app.models import Base
 
 DATABASE_URL = os.getenv(
@@ -11,7 +13,13 @@ DATABASE_URL = os.getenv(
     "postgresql+asyncpg://tickets:tickets@db:5432/tickets_db",
 )
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+engine = create_async_engine(
+    DATABASE_URL, echo=False, future=True,
+    pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+)
 
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
@@ -20,6 +28,70 @@ AsyncSessionLocal = async_sessionmaker(
 )
 
 
+# ── Optional read replica ────────────────────────────────────────────────────
+# Read-only endpoints use the replica when it is configured, reachable and
+# no more than REPLICA_MAX_LAG_SEC behind; otherwise they fall back to primary.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
+REPLICA_MAX_LAG_SEC = float(os.getenv("REPLICA_MAX_LAG_SEC", "5"))
+REPLICA_CHECK_INTERVAL_SEC = float(os.getenv("REPLICA_CHECK_INTERVAL_SEC", "5"))
+
+replica_engine = (
+    create_async_engine(
+        DATABASE_REPLICA_URL, echo=False, future=True, pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+    )
+    if DATABASE_REPLICA_URL else None
+)
+
+ReplicaSessionLocal = (
+    async_sessionmaker(bind=replica_engine, class_=AsyncSession, expire_on_commit=False)
+    if replica_engine is not None else None
+)
+
+_replica_ok = False
+_replica_checked_at = 0.0
+
+# 0 on a primary / non-recovering instance (e.g. the same server behind a second URL)
+_LAG_SQL = text(
+    "SELECT CASE WHEN pg_is_in_recovery() "
+    "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+    "ELSE 0 END"
+)
+
+
+async def replica_usable() -> bool:
+    """Cached health + staleness check; at most one probe per interval."""
+    global _replica_ok, _replica_checked_at
+    if replica_engine is None:
+        return False
+    now = time.monotonic()
+    if now - _replica_checked_at < REPLICA_CHECK_INTERVAL_SEC:
+        return _replica_ok
+    _replica_checked_at = now
+    try:
+        async with replica_engine.connect() as conn:
+            lag = (await conn.execute(_LAG_SQL)).scalar() or 0
+        _replica_ok = float(lag) <= REPLICA_MAX_LAG_SEC
+    except Exception as e:
+        print(f"Read replica unavailable, using primary: {e}")
+        _replica_ok = False
+    return _replica_ok
+
+
+async def read_sessionmaker() -> async_sessionmaker:
+    return ReplicaSessionLocal if await replica_usable() else AsyncSessionLocal
+
+
+async def get_read_db():
+    """Session for read-only endpoints — replica when healthy, else primary."""
+    factory = await read_sessionmaker()
+    async with factory() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         try:
@@ -28,6 +100,30 @@ async def get_db():
             await session.close()
 
 
+# Additive column migrations for tables that predate create_all() picking them up
+_COLUMN_MIGRATIONS = [
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS analysis_source VARCHAR(20)",
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS enriched_at TIMESTAMP",
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP",
+    "ALTER TABLE managers ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true",
+    "ALTER TABLE business_units ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true",
+    # ON CONFLICT (full_name) in sync_managers needs a unique index
+    "CREATE UNIQUE INDEX IF NOT EXISTS managers_full_name_key ON managers (full_name)",
+    # Server-side change stamp covering every writer, bulk updates included
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_tickets_updated_at ON tickets (updated_at)",
+    "CREATE OR REPLACE FUNCTION tickets_touch() RETURNS trigger AS $$ "
+    "BEGIN NEW.updated_at := clock_timestamp() AT TIME ZONE 'utc'; RETURN NEW; END $$ "
+    "LANGUAGE plpgsql",
+    "CREATE OR REPLACE TRIGGER tickets_touch BEFORE INSERT OR UPDATE ON tickets "
+    "FOR EACH ROW EXECUTE FUNCTION tickets_touch()",
+    "UPDATE tickets SET updated_at = COALESCE(processed_at, created_at) WHERE updated_at IS NULL",
+]
+
+
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        for stmt in _COLUMN_MIGRATIONS:
+            await conn.execute(text(stmt))
@@ -0,0 +1,104 @@
+"""
+In-process broadcast of processing events for the dashboard (SSE).
+
+Publishers never block: each subscriber has a bounded queue, and a
+subscriber whose queue is full is dropped (it can reconnect and resync
+from /stats). Per-ticket events are also folded into aggregate deltas
+that are flushed on a timer, so clients that only need counters can
+ignore the per-ticket stream.
+"""
+import asyncio
+import json
+from collections import Counter
+from typing import Any, Dict, Optional, Set
+
+SUBSCRIBER_BUFFER = 256
+DELTA_INTERVAL_SEC = 2.0
+KEEPALIVE_SEC = 15.0
+
+
+class _Subscriber:
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+
+class Broadcaster:
+    def __init__(self, buffer: int = SUBSCRIBER_BUFFER):
+        self._buffer = buffer
+        self._subs: Set[_Subscriber] = set()
+        self._delta: Dict[str, Counter] = self._empty_delta()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _empty_delta() -> Dict[str, Counter]:
+        return {"processed": Counter(), "by_type": Counter(), "by_office": Counter()}
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subs)
+
+    def publish(self, event: Dict[str, Any]):
+        """Non-blocking fan-out. Safe to call from the processing pipeline."""
+        if event.get("type") == "ticket":
+            self._delta["processed"]["count"] += 1
+            if event.get("ticket_type"):
+                self._delta["by_type"][event["ticket_type"]] += 1
+            if event.get("office"):
+                self._delta["by_office"][event["office"]] += 1
+        if not self._subs:
+            return
+        for sub in list(self._subs):
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow consumer — cut it loose rather than stall the pipeline
+                sub.dropped = True
+                self._subs.discard(sub)
+
+    def _flush_delta(self):
+        delta, self._delta = self._delta, self._empty_delta()
+        if not delta["processed"]:
+            return
+        self.publish({
+            "type": "stats_delta",
+            "processed": delta["processed"]["count"],
+            "by_type": dict(delta["by_type"]),
+            "by_office": dict(delta["by_office"]),
+        })
+
+    async def _delta_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self._flush_delta()
+
+    def start(self, interval: float = DELTA_INTERVAL_SEC):
+        if self._task is None:
+            self._task = asyncio.create_task(self._delta_loop(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def stream(self):
+        """Async generator of SSE-encoded frames for one client."""
+        sub = _Subscriber(self._buffer)
+        self._subs.add(sub)
+        try:
+            yield "retry: 3000\n\n"
+            while not sub.dropped:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+            yield 'event: overflow\ndata: {"type": "overflow"}\n\n'
+        finally:
+            self._subs.discard(sub)
+
+
+broadcaster = Broadcaster()
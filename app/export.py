@@ -0,0 +1,120 @@
+"""
+Streaming encoders for bulk ticket export.
+
+Each encoder consumes an async iterator of row batches (lists of dicts)
+and yields bytes, so memory use is bounded by one batch regardless of
+how many rows the query returns.
+"""
+import csv
+import io
+from typing import AsyncIterator, Dict, List, Any
+
+EXPORT_BATCH_SIZE = 1000
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+Batches = AsyncIterator[List[Dict[str, Any]]]
+
+
+async def encode_ndjson(batches: Batches) -> AsyncIterator[bytes]:
+    import orjson
+
+    async for batch in batches:
+        yield b"".join(orjson.dumps(row) + b"\n" for row in batch)
+
+
+async def encode_csv(batches: Batches, columns: List[str]) -> AsyncIterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columns)
+    writer.writeheader()
+    async for batch in batches:
+        writer.writerows(batch)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back in chunks."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        b = bytes(data)
+        self._chunks.append(b)
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+def arrow_schema(columns: List[Any]):
+    """
+    Arrow schema from the selected SQLAlchemy columns. Inferring it from
+    the first batch types all-NULL columns as `null`, which later batches
+    cannot be cast to.
+    """
+    import pyarrow as pa
+    from sqlalchemy import Boolean, DateTime, Float, Integer
+
+    fields = []
+    for col in columns:
+        t = col.type
+        if isinstance(t, Boolean):
+            pa_type = pa.bool_()
+        elif isinstance(t, Integer):
+            pa_type = pa.int64()
+        elif isinstance(t, Float):
+            pa_type = pa.float64()
+        elif isinstance(t, DateTime):
+            pa_type = pa.timestamp("us")
+        else:
+            pa_type = pa.string()
+        fields.append(pa.field(col.key, pa_type, nullable=True))
+    return pa.schema(fields)
+
+
+async def encode_parquet(batches: Batches, columns: List[Any]) -> AsyncIterator[bytes]:
+    """
+    One Parquet row group per batch; the footer is written on close.
+    `columns` are the selected SQLAlchemy columns and fix the file schema.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    async for batch in batches:
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        yield sink.drain()
+    # An empty result still yields a valid file with the requested columns
+    writer.close()
+    yield sink.drain()
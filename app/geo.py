@@ -3,31 +3,114 @@ import re
 import time
 import json
 import os
-import requests
+import threading
+from collections import Counter
 from typing import Optional, Tuple, Dict, Any, List
 
 NOMINATIM_USER_AGENT = "tickets-routing/1.0"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
 CACHE_FILE = "/tmp/geocode_cache.json"
+# Misses arrive from many executor threads; write the file at most this often
+CACHE_SAVE_INTERVAL_SEC = float(os.getenv("GEOCODE_CACHE_SAVE_SEC", "5"))
 
 _cache: Dict[str, Any] = {}
+_cache_loaded = False
+_cache_lock = threading.Lock()     # guards _cache mutation and the loaded flag
+_save_lock = threading.Lock()      # one writer of CACHE_FILE at a time
+_cache_dirty = False
+_cache_saved_at = float("-inf")   # never saved
 
 
 def _load_cache():
-    global _cache
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
-                _cache = json.load(f)
-        except Exception:
-            _cache = {}
+    """Read the on-disk cache on first use rather than at import time."""
+    global _cache, _cache_loaded
+    if _cache_loaded:
+        return
+    with _cache_lock:
+        if _cache_loaded:
+            return
+        data: Dict[str, Any] = {}
+        if os.path.exists(CACHE_FILE):
+            try:
+                with open(CACHE_FILE, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception:
+                data = {}
+        _cache = data
+        # Only now: a concurrent lookup must never see (and save) an empty cache
+        _cache_loaded = True
 
 
-def _save_cache():
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(_cache, f, ensure_ascii=False, indent=2)
+_http = None
+_http_lock = threading.Lock()
 
 
-_load_cache()
+def http_session():
+    """Shared keep-alive session so cache misses skip the TLS handshake."""
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                import requests  # deferred: only needed on a cache miss
+
+                _http = requests.Session()
+                _http.headers.update({"User-Agent": NOMINATIM_USER_AGENT, "Accept-Language": "ru,en"})
+    return _http
+
+
+def warm_up(connect: bool = True) -> None:
+    """Load the on-disk cache and open a connection to Nominatim."""
+    _load_cache()
+    if not connect:
+        return
+    try:
+        http_session().head(NOMINATIM_URL, timeout=5)
+    except Exception as e:
+        print(f"Nominatim warm-up failed: {e}")
+
+
+def _cache_put(key: str, lat: Optional[float], lon: Optional[float]):
+    global _cache_dirty
+    with _cache_lock:
+        _cache[key] = {"lat": lat, "lon": lon}
+        _cache_dirty = True
+    _save_cache()
+
+
+def _save_cache(force: bool = False):
+    """
+    Debounced: at most once per CACHE_SAVE_INTERVAL_SEC unless forced, and
+    skipped if another thread is already writing. The dict is serialised
+    under the cache lock and written via a temp file, so a save never sees
+    a dict mid-update and a crash never leaves a half-written file.
+    """
+    global _cache_dirty, _cache_saved_at
+    if not force and time.monotonic() - _cache_saved_at < CACHE_SAVE_INTERVAL_SEC:
+        return
+    if not _save_lock.acquire(blocking=force):
+        return
+    try:
+        with _cache_lock:
+            if not _cache_dirty:
+                return
+            data = json.dumps(_cache, ensure_ascii=False, indent=2)
+            _cache_dirty = False
+        tmp = CACHE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, CACHE_FILE)
+        _cache_saved_at = time.monotonic()
+    except Exception as e:
+        _cache_dirty = True
+        print(f"Geocode cache save failed: {e}")
+    finally:
+        _save_lock.release()
+
+
+def flush_cache():
+    """Write pending cache entries now (shutdown)."""
+    if _cache_loaded:
+        _save_cache(force=True)
 
 
 def remove_control_chars(s: str) -> str:
@@ -81,17 +164,16 @@ def geocode_single(query: str, sleep_sec: float = 1.0) -> Tuple[Optional[float],
     if not query:
         return None, None
 
-    if query in _cache:
-        v = _cache[query]
+    _load_cache()
+    v = _cache.get(query)
+    if v is not None:
         return v.get("lat"), v.get("lon")
 
-    url = "https://nominatim.openstreetmap.org/search"
     params = {"format": "json", "limit": 1, "q": query}
-    headers = {"User-Agent": NOMINATIM_USER_AGENT, "Accept-Language": "ru,en"}
 
     lat = lon = None
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=25)
+        resp = http_session().get(NOMINATIM_URL, params=params, timeout=25)
         resp.raise_for_status()
         data = resp.json()
         if data:
@@ -100,12 +182,197 @@ def geocode_single(query: str, sleep_sec: float = 1.0) -> Tuple[Optional[float],
     except Exception:
         pass
 
-    _cache[query] = {"lat": lat, "lon": lon}
-    _save_cache()
+    _cache_put(query, lat, lon)
     time.sleep(max(0.0, sleep_sec))
     return lat, lon
 
 
+# ── Canonical structured keys ─────────────────────────────────────────────────
+# Address variants ("г. Алматы, ул. Абая 10" / "Алматы, Абая, 10" / "Almaty")
+# collapse to one key: kz|region|city|street|house.
+
+_PREFIXES = [
+    "республика", "область", "обл", "район", "р-н", "город", "гор", "г",
+    "улица", "ул", "проспект", "пр-т", "просп", "пр", "бульвар", "бул", "б-р",
+    "переулок", "пер", "шоссе", "ш", "микрорайон", "мкр-н", "мкр", "мкрн",
+    "дом", "д", "здание", "зд", "корпус", "корп", "к", "квартира", "кв",
+    "көшесі", "даңғылы", "ауданы", "облысы", "қаласы",
+    "street", "st", "avenue", "ave", "city", "region", "oblast",
+]
+_PREFIX_RE = re.compile(
+    r"(?<![\w-])(?:" + "|".join(re.escape(p) for p in sorted(_PREFIXES, key=len, reverse=True)) + r")\.?(?![\w-])",
+    re.IGNORECASE,
+)
+
+# Historical names, Kazakh spellings and Latin transliterations → canonical city
+_CITY_ALIASES = {
+    "алма-ата": "алматы", "алма ата": "алматы", "almaty": "алматы", "alma-ata": "алматы",
+    "нур-султан": "астана", "нур султан": "астана", "нурсултан": "астана",
+    "целиноград": "астана", "акмола": "астана", "astana": "астана", "nur-sultan": "астана",
+    "шымкент": "шымкент", "чимкент": "шымкент", "shymkent": "шымкент",
+    "караганда": "караганда", "қарағанды": "караганда", "karaganda": "караганда",
+    "актобе": "актобе", "актюбинск": "актобе", "ақтөбе": "актобе", "aktobe": "актобе",
+    "актау": "актау", "шевченко": "актау", "ақтау": "актау", "aktau": "актау",
+    "атырау": "атырау", "гурьев": "атырау", "atyrau": "атырау",
+    "уральск": "уральск", "орал": "уральск", "oral": "уральск", "uralsk": "уральск",
+    "усть-каменогорск": "усть-каменогорск", "өскемен": "усть-каменогорск",
+    "оскемен": "усть-каменогорск", "oskemen": "усть-каменогорск",
+    "ust-kamenogorsk": "усть-каменогорск",
+    "семей": "семей", "семипалатинск": "семей", "semey": "семей",
+    "павлодар": "павлодар", "pavlodar": "павлодар",
+    "петропавловск": "петропавловск", "петропавл": "петропавловск", "petropavl": "петропавловск",
+    "костанай": "костанай", "кустанай": "костанай", "қостанай": "костанай", "kostanay": "костанай",
+    "кокшетау": "кокшетау", "кокчетав": "кокшетау", "көкшетау": "кокшетау", "kokshetau": "кокшетау",
+    "тараз": "тараз", "джамбул": "тараз", "жамбыл": "тараз", "taraz": "тараз",
+    "кызылорда": "кызылорда", "қызылорда": "кызылорда", "kyzylorda": "кызылорда",
+    "талдыкорган": "талдыкорган", "талдықорған": "талдыкорган", "taldykorgan": "талдыкорган",
+    "туркестан": "туркестан", "түркістан": "туркестан", "turkestan": "туркестан",
+    "экибастуз": "экибастуз", "екібастұз": "экибастуз",
+    "темиртау": "темиртау", "теміртау": "темиртау",
+    "жезказган": "жезказган", "жезқазған": "жезказган",
+    "конаев": "конаев", "капчагай": "конаев", "қонаев": "конаев",
+}
+
+_KZ_TO_RU = str.maketrans({"ә": "а", "ғ": "г", "қ": "к", "ң": "н", "ө": "о",
+                           "ұ": "у", "ү": "у", "һ": "х", "і": "и", "ё": "е"})
+
+
+def _canon_part(s: str) -> str:
+    s = remove_control_chars(s or "").lower()
+    s = _PREFIX_RE.sub(" ", s)
+    s = re.sub(r"[\"'«»().,;:№#]", " ", s)
+    s = re.sub(r"\s+", " ", s).strip(" -")
+    return s
+
+
+def _canon_city(s: str) -> str:
+    c = _canon_part(s)
+    c = _CITY_ALIASES.get(c, c)
+    return c.translate(_KZ_TO_RU)
+
+
+def _canon_region(s: str) -> str:
+    r = _canon_part(s).translate(_KZ_TO_RU)
+    # "алматинская" / "алматы облысы" → "алмат": drop the Russian adjective
+    # ending, then the stem vowel the Kazakh form ends in
+    r = re.sub(r"(?:ин)?(?:ская|ской|кая|кой)$", "", r)
+    return re.sub(r"(?<=\w{3})[аыи]$", "", r)
+
+
+def _canon_house(s: str) -> str:
+    s = (s or "").strip()
+    if s.endswith(".0") and s[:-2].isdigit():
+        s = s[:-2]
+    return _canon_part(s).replace(" ", "")
+
+
+def canonical_key(
+    country: str, region: str, city: str, street: str = "", house: str = "",
+) -> Tuple[str, str, str, str, str]:
+    cc = "kz" if is_kazakhstan(country or "") else _canon_part(country)
+    return (
+        cc,
+        _canon_region(region),
+        _canon_city(city),
+        _canon_part(street).translate(_KZ_TO_RU),
+        _canon_house(house),
+    )
+
+
+def _key_str(key: Tuple[str, ...]) -> str:
+    return "|".join(key)
+
+
+_stats_lock = threading.Lock()
+_geo_stats: Counter = Counter()
+_legacy_seen: set = set()
+_LEGACY_SEEN_MAX = 50_000   # a rolling sample is enough for the comparison stat
+
+
+def geocode_cache_stats() -> Dict[str, Any]:
+    """Canonical-key hit rate vs. what the old free-text keys would have hit."""
+    with _stats_lock:
+        n = _geo_stats["lookups"]
+        return {
+            "lookups": n,
+            "canonical_hits": _geo_stats["hits"],
+            "canonical_hit_rate": _geo_stats["hits"] / n if n else None,
+            "legacy_hits": _geo_stats["legacy_hits"],
+            "legacy_hit_rate": _geo_stats["legacy_hits"] / n if n else None,
+            "hits_by_level": {
+                lvl: _geo_stats[f"hit_{lvl}"] for lvl in ("house", "street", "city")
+            },
+            "nominatim_calls": _geo_stats["remote"],
+        }
+
+
+def _nominatim_structured(params: Dict[str, str]) -> Tuple[Optional[float], Optional[float]]:
+    query = {"format": "json", "limit": 1, "countrycodes": "kz", **params}
+    try:
+        resp = http_session().get(NOMINATIM_URL, params=query, timeout=25)
+        resp.raise_for_status()
+        data = resp.json()
+        if data:
+            return float(data[0]["lat"]), float(data[0]["lon"])
+    except Exception:
+        pass
+    return None, None
+
+
+def geocode_structured(
+    country: str, region: str, city: str, street: str = "", house: str = "",
+    sleep_sec: float = 0.0,
+) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Hierarchical lookup on canonical keys: house → street → city.
+    Levels without data are skipped (no street → straight to the city key);
+    each level is served from cache before Nominatim is asked, and falls
+    through to the next only on a negative result.
+    """
+    _load_cache()
+    cc, rg, ct, st, hs = canonical_key(country, region, city, street, house)
+    if not ct:
+        return None, None
+
+    legacy = normalize_ru_address(f"{country}, {region}, {city}, {street}, {house}".strip())
+    with _stats_lock:
+        _geo_stats["lookups"] += 1
+        if legacy in _legacy_seen or legacy in _cache:
+            _geo_stats["legacy_hits"] += 1
+        if len(_legacy_seen) >= _LEGACY_SEEN_MAX:
+            _legacy_seen.clear()
+        _legacy_seen.add(legacy)
+
+    levels = []
+    if st and hs:
+        levels.append(("house", (cc, rg, ct, st, hs), {"street": f"{house} {street}", "city": city}))
+    if st:
+        levels.append(("street", (cc, rg, ct, st, ""), {"street": street, "city": city}))
+    levels.append(("city", (cc, rg, ct, "", ""), {"city": city, "state": region}))
+
+    # Finest first. A coarser level is used only once every finer one is
+    # known to have no result (a cached negative, or Nominatim found nothing);
+    # otherwise one cached city centre would mask every street address in it.
+    for lvl, key, params in levels:
+        ks = _key_str(key)
+        v = _cache.get(ks)
+        if v is not None:
+            if v.get("lat") is not None and v.get("lon") is not None:
+                with _stats_lock:
+                    _geo_stats["hits"] += 1
+                    _geo_stats[f"hit_{lvl}"] += 1
+                return v["lat"], v["lon"]
+            continue
+        lat, lon = _nominatim_structured({k: v for k, v in params.items() if v})
+        with _stats_lock:
+            _geo_stats["remote"] += 1
+        _cache_put(ks, lat, lon)
+        time.sleep(max(0.0, sleep_sec))
+        if lat is not None and lon is not None:
+            return lat, lon
+    return None, None
+
+
 def geocode_best(queries: List[str], sleep_sec: float = 1.0) -> Tuple[Optional[float], Optional[float]]:
     for q in queries:
         if not q.strip():
@@ -0,0 +1,167 @@
+"""
+Conditional-GET cache for rarely-changing read endpoints.
+
+Each cached path depends on a set of tables. Writers bump a per-table
+version counter in-process after they commit; a cached body is served
+(or answered with 304) as long as the versions it was rendered at are
+unchanged, without running the endpoint or touching the DB. Entries do
+not expire by default. When several API processes write to the same DB,
+set HTTP_CACHE_TTL_SEC to bound staleness from the other processes'
+writes.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL_SEC = float(os.getenv("HTTP_CACHE_TTL_SEC", "0"))   # 0 = until the next bump
+
+# path → tables its response is derived from. These endpoints read from the
+# primary: a lagging replica could render pre-write data under the new
+# version token, and it would be served until the next write.
+CACHED_PATHS: Dict[str, Tuple[str, ...]] = {
+    "/offices": ("business_units",),
+    "/managers": ("managers",),
+    "/stats": ("tickets",),
+}
+
+
+class DataVersions:
+    """Monotonic per-table counters plus the wall-clock time of the last bump."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, float] = {}
+        self._started = time.time()
+
+    def bump(self, *tables: str):
+        now = time.time()
+        with self._lock:
+            for t in tables:
+                self._versions[t] = self._versions.get(t, 0) + 1
+                self._modified[t] = now
+
+    def token(self, tables: Tuple[str, ...]) -> Tuple[int, ...]:
+        return tuple(self._versions.get(t, 0) for t in tables)
+
+    def last_modified(self, tables: Tuple[str, ...]) -> float:
+        return max([self._modified.get(t, self._started) for t in tables])
+
+
+data_versions = DataVersions()
+
+
+class _Entry:
+    __slots__ = ("token", "etag", "body", "content_type", "last_modified", "stored_at")
+
+    def __init__(self, token, etag, body, content_type, last_modified):
+        self.token = token
+        self.etag = etag
+        self.body = body
+        self.content_type = content_type
+        self.last_modified = formatdate(last_modified, usegmt=True).encode("latin-1")
+        self.stored_at = time.monotonic()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison against a comma-separated If-None-Match list (RFC 9110 13.1.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == opaque:
+            return True
+    return False
+
+
+class HTTPCacheMiddleware:
+    """Pure ASGI: uncached paths cost one dict lookup."""
+
+    def __init__(self, app: ASGIApp, max_entries: int = CACHE_MAX_ENTRIES):
+        self.app = app
+        self._max = max_entries
+        self._store: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        tables = CACHED_PATHS.get(scope["path"]) if scope["type"] == "http" else None
+        if tables is None or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        inm_parts = []
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                await self.app(scope, receive, send)
+                return
+            if name == b"if-none-match":
+                inm_parts.append(value.decode("latin-1"))
+        inm = ",".join(inm_parts)
+
+        key = f"{scope['path']}?{scope.get('query_string', b'').decode('latin-1')}"
+        token = data_versions.token(tables)
+
+        entry = self._store.get(key)
+        if entry is not None and entry.token == token and (
+            not CACHE_TTL_SEC or time.monotonic() - entry.stored_at < CACHE_TTL_SEC
+        ):
+            self._store.move_to_end(key)
+            await self._respond(send, entry, etag_matches(inm, entry.etag))
+            return
+
+        # Render once, buffering the (small) response so it can be stored
+        messages: List[Message] = []
+
+        async def capture(message: Message):
+            messages.append(message)
+
+        await self.app(scope, receive, capture)
+        start = messages[0] if messages else None
+        if start is None or start["type"] != "http.response.start" or start["status"] != 200:
+            for message in messages:
+                await send(message)
+            return
+
+        body = b"".join(m.get("body", b"") for m in messages[1:] if m["type"] == "http.response.body")
+        content_type = dict(start.get("headers", [])).get(b"content-type", b"application/json")
+        entry = _Entry(
+            token,
+            '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            body,
+            content_type,
+            data_versions.last_modified(tables),
+        )
+        self._store[key] = entry
+        self._store.move_to_end(key)
+        while len(self._store) > self._max:
+            self._store.popitem(last=False)
+        await self._respond(send, entry, etag_matches(inm, entry.etag))
+
+    @staticmethod
+    async def _respond(send: Send, entry: _Entry, not_modified: bool):
+        headers = [
+            (b"etag", entry.etag.encode("latin-1")),
+            (b"last-modified", entry.last_modified),
+            (b"cache-control", b"no-cache"),
+        ]
+        if not_modified:
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        headers += [
+            (b"content-type", entry.content_type),
+            (b"content-length", str(len(entry.body)).encode("latin-1")),
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": entry.body})
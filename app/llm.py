@@ -1,8 +1,22 @@
+"""
+Ticket analysis via the OpenAI API.
+
+Calls go through a per-class model cascade: a fast model answers first and
+low-confidence or schema-invalid outputs escalate to a stronger one. A
+call still running past its model's running p95 latency is hedged with a
+duplicate request; whichever answers first wins.
+Benchmark against a local fake provider: python tests/bench_llm.py --tickets 2000
+"""
 import os
 import json
 import time
-from typing import Dict, Any
-from openai import OpenAI
+import queue
+import threading
+from collections import deque
+from typing import Callable, Dict, Any, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 CATEGORIES = [
     "Жалоба", "Смена данных", "Консультация", "Претензия",
@@ -11,18 +25,498 @@ CATEGORIES = [
 SENTIMENTS = ["Позитивный", "Нейтральный", "Негативный"]
 LANGS = ["KZ", "ENG", "RU"]
 
-_client: OpenAI = None
+_client: "OpenAI" = None
+
+
+class LLMUnavailable(Exception):
+    """Raised by llm_analyze_ticket(raise_on_failure=True) once retries are exhausted."""
 
 
-def get_openai_client() -> OpenAI:
+class LLMBudgetExceeded(Exception):
+    """Raised when a run-level budget (deadline, tokens, calls) stops LLM work."""
+
+
+def get_openai_client() -> "OpenAI":
     global _client
     if _client is None:
+        from openai import OpenAI  # deferred: the SDK is slow to import
+
         api_key = os.getenv("OPENAI_API_KEY", "")
         _client = OpenAI(api_key=api_key)
     return _client
 
 
-def llm_analyze_ticket(text: str, max_retries: int = 4) -> Dict[str, Any]:
+def warm_up(connect: bool = True) -> None:
+    """Import the SDK and tokenizer, and open the HTTPS connection to the API."""
+    _get_encoding()
+    client = get_openai_client()
+    if not connect or not os.getenv("OPENAI_API_KEY"):
+        return
+    try:
+        client.models.list()   # free call; leaves a pooled keep-alive connection
+    except Exception as e:
+        print(f"OpenAI warm-up failed: {e}")
+
+
+# Token budget for the ticket text; long descriptions keep head and tail
+MAX_INPUT_TOKENS = int(os.getenv("LLM_MAX_INPUT_TOKENS", "2000"))
+HEAD_SHARE = 0.7
+TRUNCATION_MARK = "\n…\n"
+
+# Instructions and schema are module constants so the request prefix is
+# byte-identical across calls and provider-side prompt caching applies.
+INSTRUCTIONS = (
+    "Ты — NLP модуль службы поддержки.\n"
+    "Проанализируй текст обращения и верни JSON строго по схеме.\n\n"
+    "Правила:\n"
+    f"- type: строго одна категория из списка: {', '.join(CATEGORIES)}.\n"
+    f"- sentiment: строго одно из: {', '.join(SENTIMENTS)}.\n"
+    "- priority: целое 1..10.\n"
+    "  Спам: 1-2; Консультация: 3-5; Жалоба/Смена данных: 5-7; "
+    "Неработоспособность приложения: 7-9; Претензия: 8-10; Мошенничество: 9-10.\n"
+    f"- language: строго KZ/ENG/RU. Если сомневаешься — RU.\n"
+    "- summary: 1-2 предложения: суть + следующий шаг. Без 'Менеджеру:'.\n"
+    "- confidence: число 0..1 — насколько ты уверен в type и priority.\n"
+    "Никакого текста вне JSON."
+)
+
+JSON_SCHEMA = {
+    "type": "json_schema",
+    "name": "ticket_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": CATEGORIES},
+            "sentiment": {"type": "string", "enum": SENTIMENTS},
+            "priority": {"type": "integer", "minimum": 1, "maximum": 10},
+            "language": {"type": "string", "enum": LANGS},
+            "summary": {"type": "string"},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        },
+        "required": ["type", "sentiment", "priority", "language", "summary", "confidence"],
+        "additionalProperties": False,
+    },
+}
+
+
+# ── Token accounting ──────────────────────────────────────────────────────────
+
+class TokenUsage:
+    """Thread-safe running totals; llm calls execute in a thread pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latency_sec = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def record(self, prompt: int, cached: int, completion: int, latency: float = 0.0):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt
+            self.cached_tokens += cached
+            self.completion_tokens += completion
+            self.latency_sec += latency
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cache_hit_rate": (
+                    self.cached_tokens / self.prompt_tokens if self.prompt_tokens else None
+                ),
+                "avg_latency_sec": self.latency_sec / self.calls if self.calls else None,
+            }
+
+
+usage = TokenUsage()
+
+
+def _usage_counts(u) -> Tuple[int, int, int]:
+    """
+    Normalise Responses (input/output) and Chat (prompt/completion) usage
+    objects to (prompt, cached, completion).
+    """
+    prompt = getattr(u, "input_tokens", None)
+    if prompt is None:
+        prompt = getattr(u, "prompt_tokens", 0) or 0
+    completion = getattr(u, "output_tokens", None)
+    if completion is None:
+        completion = getattr(u, "completion_tokens", 0) or 0
+    details = (
+        getattr(u, "input_tokens_details", None)
+        or getattr(u, "prompt_tokens_details", None)
+    )
+    cached = getattr(details, "cached_tokens", 0) or 0
+    return prompt, cached, completion
+
+
+def _record_usage(u, latency: float, sink: Optional[TokenUsage] = None) -> None:
+    """Failed calls arrive with u=None and still count as a call."""
+    prompt, cached, completion = _usage_counts(u)
+    usage.record(prompt, cached, completion, latency)
+    if sink is not None:
+        sink.record(prompt, cached, completion, latency)
+
+
+# ── Token-aware truncation ────────────────────────────────────────────────────
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False   # fall back to a character heuristic
+    return _encoding
+
+
+def truncate_tokens(text: str, max_tokens: int = MAX_INPUT_TOKENS) -> str:
+    """Keep the first ~70% and last ~30% of the token budget."""
+    enc = _get_encoding()
+    if enc:
+        ids = enc.encode(text)
+        if len(ids) <= max_tokens:
+            return text
+        head = int(max_tokens * HEAD_SHARE)
+        tail = max_tokens - head
+        return enc.decode(ids[:head]) + TRUNCATION_MARK + enc.decode(ids[-tail:])
+
+    # ~3 chars per token is conservative for mixed Cyrillic/Latin text
+    max_chars = max_tokens * 3
+    if len(text) <= max_chars:
+        return text
+    head = int(max_chars * HEAD_SHARE)
+    return text[:head] + TRUNCATION_MARK + text[-(max_chars - head):]
+
+
+# Flipped off once if the SDK/endpoint lacks the Responses API
+_responses_supported = True
+
+
+def _call_model(client, model: str, text: str) -> Tuple[str, Any]:
+    """
+    One model call → (output text, usage object).
+    Uses Chat Completions only when Responses is unavailable.
+    """
+    global _responses_supported
+    if _responses_supported:
+        try:
+            resp = client.responses.create(
+                model=model,
+                instructions=INSTRUCTIONS,
+                input=text,
+                temperature=0,
+                text={"format": JSON_SCHEMA},
+            )
+        except (AttributeError, TypeError) as e:
+            print(f"Responses API unavailable, using chat completions: {e}")
+            _responses_supported = False
+        else:
+            return (resp.output_text or "").strip(), getattr(resp, "usage", None)
+
+    resp = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": INSTRUCTIONS},
+            {"role": "user", "content": text},
+        ],
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    return (resp.choices[0].message.content or "").strip(), getattr(resp, "usage", None)
+
+
+# ── Model cascade ─────────────────────────────────────────────────────────────
+
+FAST_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+STRONG_MODEL = os.getenv("OPENAI_STRONG_MODEL", "gpt-4o")
+MIN_CONFIDENCE = float(os.getenv("LLM_MIN_CONFIDENCE", "0.7"))
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "1") == "1"
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20          # no hedging until the p95 estimate means something
+HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+
+DEFAULT_CASCADE: Dict[str, Any] = {
+    "models": [FAST_MODEL, STRONG_MODEL] if STRONG_MODEL else [FAST_MODEL],
+    "min_confidence": MIN_CONFIDENCE,
+    "hedge": HEDGE_ENABLED,
+}
+
+# Per service class (scheduler.CLASS_WEIGHTS) overrides of DEFAULT_CASCADE, e.g.
+# LLM_CASCADE='{"VIP": {"models": ["gpt-4o"]}, "Mass": {"hedge": false}}'
+CASCADE_OVERRIDES: Dict[str, Dict[str, Any]] = json.loads(os.getenv("LLM_CASCADE", "") or "{}")
+
+# USD per 1M tokens: (input, cached input, output)
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    **{k: tuple(v) for k, v in json.loads(os.getenv("LLM_MODEL_PRICES", "") or "{}").items()},
+}
+
+
+def cascade_for(ticket_class: str) -> Dict[str, Any]:
+    return {**DEFAULT_CASCADE, **CASCADE_OVERRIDES.get(ticket_class, {})}
+
+
+def call_cost(model: str, u) -> float:
+    price = MODEL_PRICES.get(model)
+    if price is None or u is None:
+        return 0.0
+    prompt, cached, completion = _usage_counts(u)
+    return ((prompt - cached) * price[0] + cached * price[1] + completion * price[2]) / 1e6
+
+
+class CascadeStats:
+    """Per-model latency windows and cost, plus escalation / hedge counters."""
+
+    def __init__(self, window: int = 2000):
+        self._lock = threading.Lock()
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency: Dict[str, deque] = {}
+            self.calls: Dict[str, int] = {}
+            self.invalid: Dict[str, int] = {}
+            self.cost_usd: Dict[str, float] = {}
+            self.tickets = 0
+            self.escalations = 0
+            self.hedges = 0
+            self.hedge_wins = 0
+
+    def record_call(self, model: str, u, latency: float, ok: bool):
+        with self._lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            self.cost_usd[model] = self.cost_usd.get(model, 0.0) + call_cost(model, u)
+            if ok:
+                self.latency.setdefault(model, deque(maxlen=self._window)).append(latency)
+
+    def count(self, counter: str):
+        """Increment one of tickets / escalations / hedge_wins."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_invalid(self, model: str):
+        with self._lock:
+            self.invalid[model] = self.invalid.get(model, 0) + 1
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.latency.get(model, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        with self._lock:
+            if len(self.latency.get(model, ())) < HEDGE_MIN_SAMPLES:
+                return None
+        return self.percentile(model, HEDGE_PERCENTILE)
+
+    def can_hedge(self) -> bool:
+        """Cap duplicates at HEDGE_MAX_RATIO of tickets so a slow provider isn't hit twice as hard."""
+        with self._lock:
+            return self.hedges + 1 <= max(1, self.tickets) * HEDGE_MAX_RATIO
+
+    def snapshot(self) -> Dict[str, Any]:
+        models = {
+            m: {
+                "calls": self.calls.get(m, 0),
+                "invalid": self.invalid.get(m, 0),
+                "p50_sec": self.percentile(m, 0.50),
+                "p99_sec": self.percentile(m, 0.99),
+                "cost_usd": round(self.cost_usd.get(m, 0.0), 6),
+            }
+            for m in sorted(self.calls)
+        }
+        with self._lock:
+            return {
+                "tickets": self.tickets,
+                "escalations": self.escalations,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "cost_usd": round(sum(self.cost_usd.values()), 6),
+                "models": models,
+            }
+
+
+cascade_stats = CascadeStats()
+
+
+def _timed_call(client, model: str, text: str, sink: Optional[TokenUsage]) -> str:
+    started = time.monotonic()
+    u = None
+    try:
+        out, u = _call_model(client, model, text)
+        return out
+    finally:
+        latency = time.monotonic() - started
+        _record_usage(u, latency, sink)
+        cascade_stats.record_call(model, u, latency, ok=u is not None)
+
+
+def _start_call(
+    results: "queue.SimpleQueue", tag: str, client, model: str, text: str,
+    sink: Optional[TokenUsage],
+) -> None:
+    """Run one call on its own daemon thread and post (tag, output, error) to `results`."""
+    def run():
+        try:
+            results.put((tag, _timed_call(client, model, text, sink), None))
+        except BaseException as e:
+            results.put((tag, None, e))
+
+    threading.Thread(target=run, name=f"llm-{tag}", daemon=True).start()
+
+
+def _hedged_call(
+    client, model: str, text: str, hedge: bool, sink: Optional[TokenUsage],
+    call_gate: Optional[Callable[[], bool]] = None,
+) -> str:
+    """
+    Send one request; if it outlives the model's running p95, send a duplicate
+    and take whichever finishes first. Sync SDK calls cannot be interrupted,
+    so the loser's answer is dropped.
+
+    Hedged calls run on their own threads rather than a shared pool: the
+    caller already holds an executor thread, and queueing behind other
+    tickets' calls would count as latency and trigger spurious hedges.
+    """
+    delay = cascade_stats.hedge_delay(model) if hedge else None
+    if delay is None:
+        return _timed_call(client, model, text, sink)
+
+    results: "queue.SimpleQueue" = queue.SimpleQueue()
+    _start_call(results, "primary", client, model, text, sink)
+    pending = 1
+    try:
+        first = results.get(timeout=delay)
+    except queue.Empty:
+        first = None
+        if cascade_stats.can_hedge() and (call_gate is None or call_gate()):
+            cascade_stats.count("hedges")
+            _start_call(results, "backup", client, model, text, sink)
+            pending = 2
+
+    last_err: Optional[BaseException] = None
+    while pending:
+        tag, out, err = first or results.get()
+        first = None
+        pending -= 1
+        if err is not None:
+            last_err = err
+            continue
+        if tag == "backup":
+            cascade_stats.count("hedge_wins")
+        return out
+    raise last_err
+
+
+def _validate(data: Any) -> Optional[Dict[str, Any]]:
+    """Schema check for outputs that didn't go through strict json_schema (chat fallback)."""
+    if not isinstance(data, dict):
+        return None
+    try:
+        priority = int(data["priority"])
+        confidence = float(data.get("confidence", 0))
+    except (KeyError, TypeError, ValueError):
+        return None
+    summary = data.get("summary")
+    if (
+        data.get("type") not in CATEGORIES
+        or data.get("sentiment") not in SENTIMENTS
+        or data.get("language") not in LANGS
+        or not 1 <= priority <= 10
+        or not isinstance(summary, str) or not summary.strip()
+    ):
+        return None
+    return {
+        "type": data["type"],
+        "sentiment": data["sentiment"],
+        "priority": priority,
+        "language": data["language"],
+        "summary": summary.strip(),
+        "confidence": min(max(confidence, 0.0), 1.0),
+    }
+
+
+def _run_cascade(
+    client, text: str, cfg: Dict[str, Any],
+    sink: Optional[TokenUsage], deadline: Optional[float],
+    call_gate: Optional[Callable[[], bool]] = None,
+) -> Dict[str, Any]:
+    models: List[str] = cfg["models"]
+    fallback: Optional[Dict[str, Any]] = None
+    for tier, model in enumerate(models):
+        last = tier == len(models) - 1
+        if call_gate is not None and not call_gate():
+            if fallback is not None:
+                break
+            raise LLMBudgetExceeded("run call budget exhausted")
+        out = _hedged_call(client, model, text, cfg["hedge"], sink, call_gate)
+        try:
+            result = _validate(json.loads(out)) if out else None
+        except ValueError:
+            result = None
+
+        if result is None:
+            cascade_stats.record_invalid(model)
+            if last:
+                if fallback is not None:
+                    break
+                raise ValueError(f"{model} output failed schema validation")
+        elif last or result["confidence"] >= cfg["min_confidence"]:
+            result.pop("confidence")
+            return result
+        else:
+            fallback = result   # low confidence but usable if escalation fails
+
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        cascade_stats.count("escalations")
+
+    if fallback is None:
+        raise LLMBudgetExceeded("run budget reached during escalation")
+    fallback.pop("confidence")
+    return fallback
+
+
+def llm_analyze_ticket(
+    text: str,
+    max_retries: int = 4,
+    raise_on_failure: bool = False,
+    usage_sink: Optional[TokenUsage] = None,
+    deadline: Optional[float] = None,
+    ticket_class: str = "Mass",
+    call_gate: Optional[Callable[[], bool]] = None,
+    client=None,
+    cascade: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    `usage_sink` receives per-call token/latency accounting in addition to
+    the process-wide totals; `deadline` (time.monotonic()) stops retrying
+    once passed and raises LLMBudgetExceeded. `call_gate` is asked before
+    every provider call (retries, escalations and hedges included) and
+    refusing also raises LLMBudgetExceeded. `ticket_class` selects the
+    cascade configuration (see cascade_for) unless `cascade` is given;
+    `client` defaults to the shared OpenAI client.
+    """
     text = (text or "").strip()
     if not text:
         return {
@@ -33,82 +527,33 @@ def llm_analyze_ticket(text: str, max_retries: int = 4) -> Dict[str, Any]:
             "summary": "Текст обращения отсутствует. Запросить у клиента уточнение сути и деталей.",
         }
 
-    if len(text) > 8000:
-        text = text[:8000] + "…"
-
-    model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-
-    instructions = (
-        "Ты — NLP модуль службы поддержки.\n"
-        "Проанализируй текст обращения и верни JSON строго по схеме.\n\n"
-        "Правила:\n"
-        f"- type: строго одна категория из списка: {', '.join(CATEGORIES)}.\n"
-        f"- sentiment: строго одно из: {', '.join(SENTIMENTS)}.\n"
-        "- priority: целое 1..10.\n"
-        "  Спам: 1-2; Консультация: 3-5; Жалоба/Смена данных: 5-7; "
-        "Неработоспособность приложения: 7-9; Претензия: 8-10; Мошенничество: 9-10.\n"
-        f"- language: строго KZ/ENG/RU. Если сомневаешься — RU.\n"
-        "- summary: 1-2 предложения: суть + следующий шаг. Без 'Менеджеру:'.\n"
-        "Никакого текста вне JSON."
-    )
-
-    json_schema = {
-        "type": "json_schema",
-        "name": "ticket_analysis",
-        "strict": True,
-        "schema": {
-            "type": "object",
-            "properties": {
-                "type": {"type": "string", "enum": CATEGORIES},
-                "sentiment": {"type": "string", "enum": SENTIMENTS},
-                "priority": {"type": "integer", "minimum": 1, "maximum": 10},
-                "language": {"type": "string", "enum": LANGS},
-                "summary": {"type": "string"},
-            },
-            "required": ["type", "sentiment", "priority", "language", "summary"],
-            "additionalProperties": False,
-        },
-    }
-
-    client = get_openai_client()
-    last_err = None
+    text = truncate_tokens(text)
+    cfg = cascade if cascade is not None else cascade_for(ticket_class)
+    client = client if client is not None else get_openai_client()
+    last_err: Optional[Exception] = None
+    cascade_stats.count("tickets")
 
+    # One cascade pass per attempt — failures back off instead of doubling the spend
     for attempt in range(max_retries):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise LLMBudgetExceeded("run deadline reached before LLM call")
         try:
-            resp = client.responses.create(
-                model=model,
-                instructions=instructions,
-                input=text,
-                temperature=0,
-                text={"format": json_schema},
-            )
-            out = (resp.output_text or "").strip()
-            if not out:
-                raise ValueError("Empty model output")
-            return json.loads(out)
+            return _run_cascade(client, text, cfg, usage_sink, deadline, call_gate)
+        except LLMBudgetExceeded:
+            raise
         except Exception as e:
             last_err = e
-            # Fallback: try chat completions API
-            try:
-                resp2 = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": instructions},
-                        {"role": "user", "content": text},
-                    ],
-                    temperature=0,
-                    response_format={"type": "json_object"},
-                )
-                out = resp2.choices[0].message.content.strip()
-                return json.loads(out)
-            except Exception as e2:
-                last_err = e2
-                time.sleep(1.5 ** attempt)
+            backoff = 1.5 ** attempt
+            if deadline is not None and time.monotonic() + backoff >= deadline:
+                raise LLMBudgetExceeded("run deadline reached during retries") from e
+            time.sleep(backoff)
 
+    if raise_on_failure:
+        raise LLMUnavailable(f"{type(last_err).__name__}: {last_err}") from last_err
     return {
         "type": "Консультация",
         "sentiment": "Нейтральный",
         "priority": 4,
         "language": "RU",
         "summary": f"Не удалось обработать автоматически ({type(last_err).__name__}). Нужна ручная проверка.",
-    }
\ No newline at end of file
+    }
@@ -1,33 +1,75 @@
 import os
 import json
 import asyncio
+import time
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 from sqlalchemy.orm import selectinload
 
-from app.database import init_db, get_db, AsyncSessionLocal
-from app.models import Ticket, Manager, BusinessUnit
+from app.database import (
+    init_db, get_db, get_read_db, read_sessionmaker, AsyncSessionLocal,
+    ReplicaSessionLocal, DB_POOL_SIZE,
+)
+from app.models import Ticket, Manager, BusinessUnit, DeadLetter, DuplicateLink
 from app.schemas import (
     TicketOut, TicketDetail, ManagerOut, BusinessUnitOut,
     ProcessResponse, StatsResponse, AIQueryRequest, AIQueryResponse,
-    UploadResponse,
+    UploadResponse, RebalanceResponse, DeadLetterOut,
 )
 from app.seeder import (
     seed_business_units, seed_managers, seed_tickets,
     load_business_units, load_managers, load_tickets,
+    sync_business_units, sync_managers,
     read_csv_bytes,
 )
-from app.llm import llm_analyze_ticket
-from app.geo import geocode_best, is_kazakhstan
-from app.routing import process_ticket_assignment, refresh_office_cache
-from openai import OpenAI
+from app.analytics import (
+    CATALOG as ANALYTICS_CATALOG, MAX_QUERIES as MAX_ANALYTICS_QUERIES,
+    run_queries as run_analytics,
+)
+from app.budget import RunBudget
+from app.events import broadcaster
+from app.httpcache import HTTPCacheMiddleware, data_versions
+from app.export import (
+    EXPORT_BATCH_SIZE, MEDIA_TYPES, encode_ndjson, encode_csv, encode_parquet,
+)
+from app.llm import (
+    llm_analyze_ticket, get_openai_client, LLMBudgetExceeded, usage as llm_usage,
+    warm_up as llm_warm_up, cascade_stats as llm_cascade_stats,
+)
+from app import preclassify as preclassifier
+from app import neardup
+from app.geo import (
+    geocode_structured, geocode_cache_stats, is_kazakhstan, warm_up as geo_warm_up,
+    flush_cache as geo_flush_cache,
+)
+from app.routing import (
+    apply_enrichment, assign_ticket, choose_office, refresh_office_cache,
+)
+from app.profiling import (
+    RequestProfilerMiddleware, LOOP_LAG_ENABLED, loop_lag, require_admin, sample_stacks,
+)
+from app.rebalance import rebalance_tickets
+from app.retry import record_failure, requeue
+from app.snapshot import (
+    refresh_snapshot, schedule_full_rebuild, snapshot_loop, snapshot_status,
+    timeseries as snapshot_timeseries, manager_breakdown as snapshot_managers,
+)
+from app.sharding import SHARDING_ENABLED, coordinator
+from app import simulate as simulator
+from app import warmup
+from app.scheduler import (
+    fetch_backlog, service_class, run_queue_wait, time_to_assignment,
+)
 
 # Dedicated thread pool for blocking I/O (LLM + geocoding)
 _executor = ThreadPoolExecutor(max_workers=20)
@@ -42,10 +84,70 @@ async def lifespan(app: FastAPI):
         await seed_tickets(db)
         # Pre-load office coords into memory for fast nearest-office lookup
         await refresh_office_cache(db)
+        # Fit the local pre-classifier on previously LLM-labelled tickets
+        await preclassifier.calibrate(db, _executor)
+    # Signatures for up to 200k tickets: built off the loop, /health waits for it
+    neardup_task = asyncio.create_task(neardup.warm(AsyncSessionLocal, _executor))
+    neardup_save_task = asyncio.create_task(neardup.save_loop())
+    broadcaster.start()
+    if SHARDING_ENABLED:
+        coordinator.start()
+    snapshot_task = asyncio.create_task(snapshot_loop())
+    if LOOP_LAG_ENABLED:
+        loop_lag.start()
+    warmup_task = asyncio.create_task(_warm_up(neardup_task))
     yield
+    warmup_task.cancel()
+    snapshot_task.cancel()
+    neardup_save_task.cancel()
+    neardup_task.cancel()
+    if neardup.index.loaded and neardup.index.dirty:
+        neardup.index.save()
+    geo_flush_cache()
+    await loop_lag.stop()
+    if SHARDING_ENABLED:
+        await coordinator.stop()
+    await broadcaster.stop()
     _executor.shutdown(wait=False)
 
 
+async def _warm_write_path(db: AsyncSession):
+    """Backlog and manager lookups without FOR UPDATE: nothing is locked or modified."""
+    await fetch_backlog(db, 1)
+    await db.execute(
+        select(Manager).where(Manager.office_name == "Астана", Manager.active.is_(True))
+    )
+
+
+async def _warm_read_path(db: AsyncSession):
+    """The /tickets and /stats query shapes, run directly rather than through the endpoints."""
+    await db.execute(
+        select(*parse_fields(None, Ticket, TicketOut))
+        .order_by(Ticket.priority.desc().nullslast(), Ticket.created_at.desc())
+        .limit(50)
+    )
+    await db.execute(select(func.count()).select_from(Ticket))
+    await db.execute(
+        select(Ticket.ticket_type, func.count())
+        .where(Ticket.ticket_type.isnot(None))
+        .group_by(Ticket.ticket_type)
+    )
+
+
+async def _warm_up(neardup_task: asyncio.Task):
+    """Connections, prepared statements and outbound keep-alives before /health says ready."""
+    n = min(warmup.WARMUP_DB_CONNECTIONS, DB_POOL_SIZE)
+    pools = {"primary": (AsyncSessionLocal, n, [_warm_write_path, _warm_read_path])}
+    if ReplicaSessionLocal is not None:
+        pools["replica"] = (ReplicaSessionLocal, n, [_warm_read_path])
+    await warmup.run(
+        pools,
+        {"openai": llm_warm_up, "geocoder": geo_warm_up},
+        executor=_executor,
+        background={"neardup": asyncio.shield(neardup_task)},
+    )
+
+
 app = FastAPI(
     title="Ticket Routing Service",
     version="1.0.0",
@@ -53,6 +155,8 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+# Innermost: cached bodies must not capture per-request CORS/gzip headers
+app.add_middleware(HTTPCacheMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -60,6 +164,40 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+class StreamAwareGZipMiddleware(GZipMiddleware):
+    """GZip, except for the SSE stream, where compression buffering would delay events."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/events":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# Dashboard list pages run to hundreds of rows — compress anything non-trivial
+app.add_middleware(StreamAwareGZipMiddleware, minimum_size=1024)
+# No-op unless X-Profile + a valid X-Admin-Token are sent
+app.add_middleware(RequestProfilerMiddleware)
+
+
+def parse_fields(fields: Optional[str], model, schema) -> list:
+    """
+    Resolve a comma-separated `fields=` value into model columns.
+    Only columns exposed by the response schema may be requested;
+    no value means every schema column.
+    """
+    allowed = list(schema.model_fields)
+    if not fields:
+        names = allowed
+    else:
+        names = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in names if f not in allowed]
+        if unknown:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}",
+            )
+    return [getattr(model, n) for n in names]
 
 
 # ─────────────────── UPLOAD ───────────────────
@@ -68,6 +206,7 @@ app.add_middleware(
 async def upload_business_units(
     file: UploadFile = File(..., description="business_units.csv"),
     replace: bool = Query(default=False, description="Delete existing records before import"),
+    sync: bool = Query(default=False, description="Upsert changes and soft-delete missing rows"),
     db: AsyncSession = Depends(get_db),
 ):
     """Upload business_units.csv. Columns: Офис, Адрес"""
@@ -82,9 +221,31 @@ async def upload_business_units(
     if "Офис" not in df.columns or "Адрес" not in df.columns:
         raise HTTPException(status_code=422, detail="CSV must have columns: Офис, Адрес")
 
+    if sync:
+        diff = await sync_business_units(db, df)
+        data_versions.bump("business_units")
+        touched = diff["touched_offices"]
+        await refresh_office_cache(db, offices=touched)
+        if diff["deactivated"]:
+            await rebalance_tickets(db, scope="orphaned")
+        return UploadResponse(
+            filename=file.filename,
+            rows_total=len(df),
+            rows_imported=diff["inserted"],
+            rows_updated=diff["updated"],
+            rows_deactivated=diff["deactivated"],
+            message=(
+                f"Synced business units: {diff['inserted']} added, {diff['updated']} updated, "
+                f"{diff['deactivated']} deactivated"
+            ),
+        )
+
     added = await load_business_units(db, df, replace=replace)
+    data_versions.bump("business_units")
     # Refresh in-memory cache after office update
     await refresh_office_cache(db)
+    if replace:
+        await rebalance_tickets(db, scope="orphaned")
     return UploadResponse(
         filename=file.filename,
         rows_total=len(df),
@@ -97,6 +258,7 @@ async def upload_business_units(
 async def upload_managers(
     file: UploadFile = File(..., description="managers.csv"),
     replace: bool = Query(default=False, description="Delete existing records before import"),
+    sync: bool = Query(default=False, description="Upsert changes and soft-delete missing rows"),
     db: AsyncSession = Depends(get_db),
 ):
     """Upload managers.csv. Columns: ФИО, Должность, Офис, Навыки, Количество обращений в работе"""
@@ -112,12 +274,38 @@ async def upload_managers(
     if not required.issubset(set(df.columns)):
         raise HTTPException(status_code=422, detail=f"CSV must have columns: {required}")
 
+    if sync:
+        diff = await sync_managers(db, df)
+        data_versions.bump("managers")
+        if diff["deactivated"]:
+            await rebalance_tickets(db, scope="orphaned")
+        return UploadResponse(
+            filename=file.filename,
+            rows_total=len(df),
+            rows_imported=diff["inserted"],
+            rows_updated=diff["updated"],
+            rows_deactivated=diff["deactivated"],
+            message=(
+                f"Synced managers: {diff['inserted']} added, {diff['updated']} updated, "
+                f"{diff['deactivated']} deactivated"
+            ),
+        )
+
     added = await load_managers(db, df, replace=replace)
+    data_versions.bump("managers", "tickets")
+    # Only a replace detaches tickets; appending managers cannot orphan any.
+    # Re-route them — routing only, no LLM/geocoding
+    reassigned = 0
+    if replace:
+        reassigned = (await rebalance_tickets(db, scope="orphaned"))["reassigned"]
     return UploadResponse(
         filename=file.filename,
         rows_total=len(df),
         rows_imported=added,
-        message=f"Imported {added} managers (replace={replace})",
+        message=(
+            f"Imported {added} managers (replace={replace}); "
+            f"reassigned {reassigned} tickets"
+        ),
     )
 
 
@@ -140,6 +328,15 @@ async def upload_tickets(
         raise HTTPException(status_code=422, detail="CSV must have column: GUID клиента")
 
     added = await load_tickets(db, df, replace=replace)
+    data_versions.bump("tickets")
+    if replace:
+        # Clusters point at deleted tickets; start over from what is left
+        neardup.index.clear()
+        await neardup.build_from_db(db, executor=_executor)
+        neardup.index.loaded = True
+        await asyncio.get_event_loop().run_in_executor(None, neardup.index.save)
+        # Deleted tickets would otherwise stay in the Parquet parts
+        schedule_full_rebuild()
     return UploadResponse(
         filename=file.filename,
         rows_total=len(df),
@@ -150,19 +347,16 @@ async def upload_tickets(
 
 # ─────────────────── TICKETS ───────────────────
 
-@app.get("/tickets", response_model=List[TicketOut], tags=["Tickets"])
-async def list_tickets(
-    skip: int = 0,
-    limit: int = 50,
+def filter_tickets(
+    q,
     office: Optional[str] = None,
     ticket_type: Optional[str] = None,
     sentiment: Optional[str] = None,
     language: Optional[str] = None,
     segment: Optional[str] = None,
     processed: Optional[bool] = None,
-    db: AsyncSession = Depends(get_db),
 ):
-    q = select(Ticket)
+    """Apply the shared /tickets query-string filters to a select()."""
     if office:
         q = q.where(Ticket.office_name == office)
     if ticket_type:
@@ -177,15 +371,89 @@ async def list_tickets(
         q = q.where(Ticket.processed_at.isnot(None))
     elif processed is False:
         q = q.where(Ticket.processed_at.is_(None))
+    return q
 
+
+@app.get("/tickets", response_model=List[TicketOut], tags=["Tickets"])
+async def list_tickets(
+    skip: int = 0,
+    limit: int = 50,
+    office: Optional[str] = None,
+    ticket_type: Optional[str] = None,
+    sentiment: Optional[str] = None,
+    language: Optional[str] = None,
+    segment: Optional[str] = None,
+    processed: Optional[bool] = None,
+    fields: Optional[str] = Query(default=None, description="Comma-separated columns to return"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """
+    Rows are selected column-by-column and serialized straight from the
+    result set — no ORM hydration and no per-row Pydantic validation.
+    """
+    q = select(*parse_fields(fields, Ticket, TicketOut))
+    q = filter_tickets(q, office, ticket_type, sentiment, language, segment, processed)
     q = q.order_by(Ticket.priority.desc().nullslast(), Ticket.created_at.desc())
     q = q.offset(skip).limit(limit)
     result = await db.execute(q)
+    return ORJSONResponse([dict(r) for r in result.mappings()])
+
+
+@app.get("/tickets/export", tags=["Tickets"])
+async def export_tickets(
+    format: Literal["ndjson", "csv", "parquet"] = Query(default="ndjson"),
+    office: Optional[str] = None,
+    ticket_type: Optional[str] = None,
+    sentiment: Optional[str] = None,
+    language: Optional[str] = None,
+    segment: Optional[str] = None,
+    processed: Optional[bool] = None,
+    fields: Optional[str] = Query(default=None, description="Comma-separated columns to return"),
+):
+    """
+    Stream the full (filtered) ticket set from a server-side cursor.
+    Memory stays constant: rows are fetched and encoded EXPORT_BATCH_SIZE at a time.
+    """
+    cols = parse_fields(fields, Ticket, TicketOut)
+    names = [c.key for c in cols]
+    q = filter_tickets(select(*cols), office, ticket_type, sentiment, language, segment, processed)
+    q = q.order_by(Ticket.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    async def batches():
+        # Own session: request-scoped dependencies are closed before the body streams
+        async with (await read_sessionmaker())() as export_db:
+            result = await export_db.stream(q)
+            async for part in result.mappings().partitions():
+                yield [dict(r) for r in part]
+
+    if format == "csv":
+        body = encode_csv(batches(), names)
+    elif format == "parquet":
+        body = encode_parquet(batches(), cols)
+    else:
+        body = encode_ndjson(batches())
+
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="tickets.{format}"'},
+    )
+
+
+@app.get("/tickets/dead-letters", response_model=List[DeadLetterOut], tags=["Tickets"])
+async def list_dead_letters(
+    skip: int = 0,
+    limit: int = 50,
+    db: AsyncSession = Depends(get_read_db),
+):
+    result = await db.execute(
+        select(DeadLetter).order_by(DeadLetter.failed_at.desc()).offset(skip).limit(limit)
+    )
     return result.scalars().all()
 
 
 @app.get("/tickets/{ticket_id}", response_model=TicketDetail, tags=["Tickets"])
-async def get_ticket(ticket_id: int, db: AsyncSession = Depends(get_db)):
+async def get_ticket(ticket_id: int, db: AsyncSession = Depends(get_read_db)):
     result = await db.execute(
         select(Ticket)
         .options(selectinload(Ticket.assigned_manager), selectinload(Ticket.office))
@@ -201,6 +469,9 @@ async def get_ticket(ticket_id: int, db: AsyncSession = Depends(get_db)):
 async def process_all_tickets(
     limit: int = Query(default=100, description="Max tickets to process"),
     concurrency: int = Query(default=15, description="Parallel workers"),
+    max_seconds: Optional[float] = Query(default=None, gt=0, description="Wall-clock budget for the run"),
+    max_tokens: Optional[int] = Query(default=None, gt=0, description="LLM token budget for the run"),
+    max_calls: Optional[int] = Query(default=None, gt=0, description="LLM call budget for the run"),
     db: AsyncSession = Depends(get_db),
 ):
     """
@@ -211,104 +482,277 @@ async def process_all_tickets(
     - Office lookup is pure in-memory (no DB per ticket)
     - DB writes use SELECT FOR UPDATE SKIP LOCKED (no Python lock needed)
     - Each ticket gets its own DB session (no contention)
+    - Enrichment is committed before routing, so retries and crashes
+      never repeat a paid LLM call; failures back off exponentially
+      and land in dead_letters after MAX_ATTEMPTS
+    - Backlog is ordered by segment + urgency with weighted fair queuing
+      (semaphore waiters are woken FIFO, so list order is service order)
     """
-    result = await db.execute(
-        select(Ticket).where(Ticket.processed_at.is_(None)).limit(limit)
-    )
-    tickets = result.scalars().all()
+    budget = RunBudget(max_seconds, max_tokens, max_calls)
+    tickets = await fetch_backlog(db, limit)
+    run_start = time.monotonic()
 
     semaphore = asyncio.Semaphore(concurrency)
     loop = asyncio.get_event_loop()
     processed_count = 0
     failed_count = 0
+    skipped_count = 0
+    deferred_count = 0
     counter_lock = asyncio.Lock()
 
+    async def enrich(ticket: Ticket):
+        """LLM + geocoding, checkpointed to the DB as soon as results arrive."""
+        # ── 1 & 2. LLM + Geocoding IN PARALLEL via thread pool ────────
+        country = ticket.country or ""
+        region  = ticket.region  or ""
+        city    = ticket.city    or ""
+        street  = ticket.street  or ""
+        house   = ticket.house   or ""
+
+        geo_parts = [p for p in [country, region, city, street, house] if p]
+        geo_normalization = ", ".join(geo_parts)
+
+        # Obvious tickets (spam, bare greetings) skip the LLM entirely
+        fast = preclassifier.preclassify(ticket.description or "")
+        preclassifier.stats["fast" if fast else "llm"] += 1
+
+        # Near-duplicates of an analysed ticket (spam waves, outage complaints)
+        # inherit the representative's analysis
+        sig = dup = None
+        if fast is None:
+            sig = neardup.signature(ticket.description or "")
+            dup = neardup.index.query(sig)
+        source = "fast" if fast else ("neardup" if dup else "llm")
+
+        # Fire both blocking calls simultaneously
+        if fast is not None:
+            llm_future = asyncio.sleep(0, result=fast)
+        elif dup is not None:
+            llm_future = asyncio.sleep(0, result=dup[2])
+        else:
+            call_gate = budget.admit()
+            if call_gate is None:
+                raise LLMBudgetExceeded(f"run budget exhausted ({budget.stopped_reason})")
+            llm_future = loop.run_in_executor(
+                _executor,
+                partial(
+                    llm_analyze_ticket, ticket.description or "",
+                    raise_on_failure=True, usage_sink=budget.usage, deadline=budget.deadline,
+                    ticket_class=service_class(ticket), call_gate=call_gate,
+                ),
+            )
+
+        if is_kazakhstan(country) and city:
+            geo_future = loop.run_in_executor(
+                _executor, geocode_structured, country, region, city, street, house
+            )
+        else:
+            geo_future = asyncio.sleep(0)  # instant no-op
+
+        # Await both — total time = max(llm_time, geo_time) not sum
+        try:
+            results = await asyncio.gather(llm_future, geo_future)
+        finally:
+            if source == "llm":
+                budget.release(call_gate)
+        ai = results[0]
+        geo_result = results[1]
+        clat, clon = geo_result if isinstance(geo_result, tuple) else (None, None)
+
+        # Checkpoint: a crash after this point never re-pays for the LLM call
+        async with AsyncSessionLocal() as enrich_db:
+            async with enrich_db.begin():
+                t = await enrich_db.get(Ticket, ticket.id)
+                if t is None or t.enriched_at is not None:
+                    return
+                apply_enrichment(t, ai, clat, clon, geo_normalization)
+                t.analysis_source = source
+                t.enriched_at = datetime.utcnow()
+                if dup is not None and await enrich_db.get(Ticket, dup[0]) is None:
+                    # Representative deleted since the lookup: keep the analysis, not the link
+                    neardup.index.discard(dup[0])
+                    dup = None
+                if dup is not None:
+                    enrich_db.add(DuplicateLink(
+                        ticket_id=t.id, representative_id=dup[0], similarity=dup[1],
+                    ))
+                if SHARDING_ENABLED:
+                    # Office decides which node assigns; the owner picks it up
+                    t.office_name = await choose_office(t, clat, clon)
+        # Bumped after commit so a concurrent read cannot cache pre-commit data
+        data_versions.bump("tickets")
+        if dup is not None:
+            neardup.index.add(ticket.id, sig, representative=dup[0])
+        elif source != "fast":
+            neardup.index.add(ticket.id, sig, analysis=ai)
+
     async def process_one(ticket: Ticket):
-        nonlocal processed_count, failed_count
+        nonlocal processed_count, failed_count, skipped_count, deferred_count
         async with semaphore:
+            if budget.exhausted():
+                # Stop scheduling cleanly; the ticket stays in the backlog untouched
+                async with counter_lock:
+                    skipped_count += 1
+                return
+            cls = service_class(ticket)
+            run_queue_wait.record(cls, time.monotonic() - run_start)
             try:
-                # ── 1 & 2. LLM + Geocoding IN PARALLEL via thread pool ────────
-                country = ticket.country or ""
-                region  = ticket.region  or ""
-                city    = ticket.city    or ""
-                street  = ticket.street  or ""
-                house   = ticket.house   or ""
-
-                geo_parts = [p for p in [country, region, city, street, house] if p]
-                geo_normalization = ", ".join(geo_parts)
-
-                # Fire both blocking calls simultaneously
-                llm_future = loop.run_in_executor(
-                    _executor, llm_analyze_ticket, ticket.description or ""
-                )
-
-                if is_kazakhstan(country) and city:
-                    queries = [
-                        f"{country}, {region}, {city}, {street}, {house}",
-                        f"{city}, {region}, Казахстан",
-                        f"{city}, Казахстан",
-                    ]
-                    geo_future = loop.run_in_executor(
-                        _executor, lambda: geocode_best(queries, sleep_sec=0.0)
-                    )
-                else:
-                    geo_future = asyncio.sleep(0)  # instant no-op
-
-                # Await both — total time = max(llm_time, geo_time) not sum
-                results = await asyncio.gather(llm_future, geo_future)
-                ai = results[0]
-                geo_result = results[1]
-                clat, clon = geo_result if isinstance(geo_result, tuple) else (None, None)
-
-                # ── 3. DB write — own session, atomic manager lock via FOR UPDATE ──
+                if ticket.enriched_at is None:
+                    await enrich(ticket)
+
+                if SHARDING_ENABLED:
+                    # Assignment is done by the node owning the ticket's office
+                    async with AsyncSessionLocal() as write_db:
+                        async with write_db.begin():
+                            t = await write_db.get(Ticket, ticket.id)
+                            if t is not None and t.office_name is None:
+                                t.office_name = await choose_office(t, t.client_lat, t.client_lon)
+                    # Enriched and queued for the owning node, not yet assigned
+                    async with counter_lock:
+                        deferred_count += 1
+                    return
+
+                # ── 3. Routing — own session, atomic manager lock via FOR UPDATE ──
                 async with AsyncSessionLocal() as write_db:
                     async with write_db.begin():
                         t = await write_db.get(Ticket, ticket.id)
                         if t is None or t.processed_at is not None:
                             return
-                        await process_ticket_assignment(
-                            write_db, t, ai, clat, clon, geo_normalization
-                        )
+                        await assign_ticket(write_db, t)
                         t.processed_at = datetime.utcnow()
                         write_db.add(t)
                         # commit happens automatically at end of begin() block
+                data_versions.bump("tickets", "managers")
+
+                broadcaster.publish({
+                    "type": "ticket",
+                    "id": t.id,
+                    "ticket_type": t.ticket_type,
+                    "priority": t.priority,
+                    "language": t.language,
+                    "office": t.office_name,
+                    "manager_id": t.manager_id,
+                })
+                if t.created_at is not None:
+                    time_to_assignment.record(
+                        cls, (t.processed_at - t.created_at).total_seconds()
+                    )
 
                 async with counter_lock:
                     processed_count += 1
 
+            except LLMBudgetExceeded:
+                # Budget stop, not a ticket fault — don't spend its retry budget
+                async with counter_lock:
+                    skipped_count += 1
             except Exception as e:
                 print(f"Error processing ticket {ticket.client_guid}: {e}")
+                try:
+                    async with AsyncSessionLocal() as err_db:
+                        await record_failure(err_db, ticket.id, f"{type(e).__name__}: {e}")
+                except Exception as e2:
+                    print(f"Could not record failure for ticket {ticket.client_guid}: {e2}")
                 async with counter_lock:
                     failed_count += 1
 
     await asyncio.gather(*[process_one(t) for t in tickets])
 
+    message = f"Processed {processed_count} tickets, {failed_count} failed."
+    if deferred_count:
+        message += f" {deferred_count} enriched and queued for their office's shard owner."
+    if budget.stopped_reason:
+        message += f" Stopped early ({budget.stopped_reason}); {skipped_count} left for the next run."
     return ProcessResponse(
         processed=processed_count,
         failed=failed_count,
-        message=f"Processed {processed_count} tickets, {failed_count} failed.",
+        skipped=skipped_count,
+        deferred=deferred_count,
+        stopped_reason=budget.stopped_reason,
+        elapsed_sec=round(budget.elapsed(), 3),
+        llm_usage=budget.usage.snapshot(),
+        message=message,
     )
 
 
+@app.post("/tickets/rebalance", response_model=RebalanceResponse, tags=["Tickets"])
+async def rebalance(
+    scope: Literal["orphaned", "office", "all"] = Query(default="orphaned"),
+    office: Optional[str] = Query(default=None, description="Required for scope=office"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Re-run only the routing step (office + manager rules) for enriched tickets,
+    using stored type/language/coordinates. No LLM or geocoding calls.
+    """
+    if scope == "office" and not office:
+        raise HTTPException(status_code=422, detail="office is required for scope=office")
+    return await rebalance_tickets(db, scope=scope, office=office)
+
+
+@app.post("/tickets/dead-letters/{ticket_id}/requeue", tags=["Tickets"])
+async def requeue_dead_letter(ticket_id: int, db: AsyncSession = Depends(get_db)):
+    """Reset the retry budget of a dead-lettered ticket."""
+    if not await requeue(db, ticket_id):
+        raise HTTPException(status_code=404, detail="Ticket is not dead-lettered")
+    data_versions.bump("tickets")
+    return {"ticket_id": ticket_id, "requeued": True}
+
+
+@app.get("/tickets/process/metrics", tags=["Tickets"])
+async def process_metrics():
+    """Per-segment queue-wait and time-to-assignment (seconds) over recent tickets."""
+    return {
+        "run_queue_wait": run_queue_wait.summary(),
+        "time_to_assignment": time_to_assignment.summary(),
+        "llm_usage": llm_usage.snapshot(),
+        "llm_cascade": llm_cascade_stats.snapshot(),
+        "geocode_cache": geocode_cache_stats(),
+        "near_duplicates": neardup.index.stats(),
+    }
+
+
+@app.get("/shards", tags=["System"])
+async def shard_status():
+    """Offices owned by this node when SHARDING_ENABLED=1."""
+    return coordinator.status()
+
+
+@app.get("/preclassifier/eval", tags=["Analytics"])
+async def preclassifier_eval(
+    recalibrate: bool = Query(default=False, description="Refit on current labels first"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Held-out accuracy of the local pre-classifier and the observed LLM-skip rate."""
+    evaluation = await preclassifier.calibrate(db, _executor) if recalibrate else preclassifier.last_eval
+    seen = sum(preclassifier.stats.values())
+    return {
+        "evaluation": evaluation,
+        "fast_path": preclassifier.stats["fast"],
+        "llm": preclassifier.stats["llm"],
+        "llm_call_rate": preclassifier.stats["llm"] / seen if seen else None,
+    }
+
+
 # ─────────────────── MANAGERS ───────────────────
 
 @app.get("/managers", response_model=List[ManagerOut], tags=["Managers"])
 async def list_managers(
     office: Optional[str] = None,
-    db: AsyncSession = Depends(get_db),
+    fields: Optional[str] = Query(default=None, description="Comma-separated columns to return"),
+    db: AsyncSession = Depends(get_db),   # cached: see httpcache.CACHED_PATHS
 ):
-    q = select(Manager)
+    q = select(*parse_fields(fields, Manager, ManagerOut))
     if office:
         q = q.where(Manager.office_name == office)
     q = q.order_by(Manager.office_name, Manager.workload)
     result = await db.execute(q)
-    return result.scalars().all()
+    return ORJSONResponse([dict(r) for r in result.mappings()])
 
 
 # ─────────────────── OFFICES ───────────────────
 
 @app.get("/offices", response_model=List[BusinessUnitOut], tags=["Offices"])
-async def list_offices(db: AsyncSession = Depends(get_db)):
+async def list_offices(db: AsyncSession = Depends(get_db)):   # cached: see httpcache.CACHED_PATHS
     result = await db.execute(select(BusinessUnit).order_by(BusinessUnit.name))
     return result.scalars().all()
 
@@ -316,7 +760,7 @@ async def list_offices(db: AsyncSession = Depends(get_db)):
 # ─────────────────── STATS ───────────────────
 
 @app.get("/stats", response_model=StatsResponse, tags=["Analytics"])
-async def get_stats(db: AsyncSession = Depends(get_db)):
+async def get_stats(db: AsyncSession = Depends(get_db)):   # cached: see httpcache.CACHED_PATHS
     total = (await db.execute(select(func.count()).select_from(Ticket))).scalar()
     processed_count = (
         await db.execute(
@@ -360,39 +804,18 @@ async def get_stats(db: AsyncSession = Depends(get_db)):
 
 # ─────────────────── AI ASSISTANT ───────────────────
 
-@app.post("/ai/query", response_model=AIQueryResponse, tags=["Analytics"])
-async def ai_query(request: AIQueryRequest, db: AsyncSession = Depends(get_db)):
-    """AI assistant: natural language → analytics + optional chart data."""
-    stats_result = await get_stats(db)
-
-    tickets_result = await db.execute(
-        select(Ticket).where(Ticket.processed_at.isnot(None)).limit(200)
-    )
-    tickets = tickets_result.scalars().all()
-
-    data_summary = {
-        "total_tickets": stats_result.total_tickets,
-        "processed_tickets": stats_result.processed_tickets,
-        "by_type": stats_result.by_type,
-        "by_sentiment": stats_result.by_sentiment,
-        "by_office": stats_result.by_office,
-        "by_language": stats_result.by_language,
-        "tickets_sample": [
-            {
-                "city": t.city, "office": t.office_name, "type": t.ticket_type,
-                "sentiment": t.sentiment, "priority": t.priority,
-                "language": t.language, "segment": t.segment,
-            }
-            for t in tickets
-        ],
-    }
-
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""))
-    model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-
-    system_prompt = """Ты — аналитик данных службы поддержки Freedom Finance.
-У тебя есть данные об обращениях клиентов.
-Отвечай на вопросы пользователя на основе предоставленных данных.
+AI_PLANNER_PROMPT = """Ты — аналитик данных службы поддержки Freedom Finance.
+Тебе недоступны сырые обращения, только агрегирующие запросы к базе.
+Доступный каталог (используй только эти имена):
+{catalog}
+По вопросу пользователя составь до {max_queries} запросов.
+Верни JSON: {{"queries": [{{"group_by": [...], "measure": "...", "filters": {{...}},
+"date_from": "YYYY-MM-DD" | null, "date_to": "YYYY-MM-DD" | null, "limit": N}}]}}.
+Если для ответа хватает общих итогов — верни {{"queries": []}}."""
+
+AI_ANSWER_PROMPT = """Ты — аналитик данных службы поддержки Freedom Finance.
+Отвечай на вопрос пользователя только на основе предоставленных итогов и результатов запросов
+(они посчитаны по всей базе, а не по выборке).
 Если вопрос подразумевает построение графика, верни JSON в поле chart_data со структурой:
 {
   "chart_type": "bar"|"pie"|"line",
@@ -405,16 +828,66 @@ async def ai_query(request: AIQueryRequest, db: AsyncSession = Depends(get_db)):
 Верни ответ в формате JSON: {"answer": "...", "chart_data": null или объект выше}.
 Отвечай на русском языке."""
 
+
+@app.post("/ai/query", response_model=AIQueryResponse, tags=["Analytics"])
+async def ai_query(request: AIQueryRequest, db: AsyncSession = Depends(get_read_db)):
+    """
+    AI assistant: natural language → analytics + optional chart data.
+
+    The model plans whitelisted aggregate queries (app.analytics), which run
+    in Postgres over the full data; only the small result tables are sent
+    back for the answer, so prompt size is independent of table size.
+    """
+    stats_result = await get_stats(db)
+    totals = {
+        "total_tickets": stats_result.total_tickets,
+        "processed_tickets": stats_result.processed_tickets,
+        "by_type": stats_result.by_type,
+        "by_sentiment": stats_result.by_sentiment,
+        "by_office": stats_result.by_office,
+        "by_language": stats_result.by_language,
+    }
+
+    client = get_openai_client()
+    model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    loop = asyncio.get_event_loop()
+
     try:
-        resp = client.chat.completions.create(
+        # Both model calls are blocking SDK calls — keep them off the event loop
+        plan = await loop.run_in_executor(_executor, partial(
+            client.chat.completions.create,
+            model=model,
+            messages=[
+                {"role": "system", "content": AI_PLANNER_PROMPT.format(
+                    catalog=json.dumps(ANALYTICS_CATALOG, ensure_ascii=False),
+                    max_queries=MAX_ANALYTICS_QUERIES,
+                )},
+                {"role": "user", "content": request.query},
+            ],
+            temperature=0,
+            response_format={"type": "json_object"},
+        ))
+        specs = json.loads(plan.choices[0].message.content).get("queries") or []
+        if not isinstance(specs, list):
+            specs = []
+        specs = [q for q in specs if isinstance(q, dict)]
+
+        results = []
+        if specs:
+            async with (await read_sessionmaker())() as adb:
+                results = await run_analytics(adb, specs)
+
+        data = {"totals": totals, "query_results": results}
+        resp = await loop.run_in_executor(_executor, partial(
+            client.chat.completions.create,
             model=model,
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Данные:\n{json.dumps(data_summary, ensure_ascii=False)}\n\nВопрос: {request.query}"},
+                {"role": "system", "content": AI_ANSWER_PROMPT},
+                {"role": "user", "content": f"Данные:\n{json.dumps(data, ensure_ascii=False, default=str)}\n\nВопрос: {request.query}"},
             ],
             temperature=0.3,
             response_format={"type": "json_object"},
-        )
+        ))
         result = json.loads(resp.choices[0].message.content)
         return AIQueryResponse(
             answer=result.get("answer", ""),
@@ -424,6 +897,154 @@ async def ai_query(request: AIQueryRequest, db: AsyncSession = Depends(get_db)):
         return AIQueryResponse(answer=f"Ошибка при обработке запроса: {e}", chart_data=None)
 
 
+# ─────────────────── ANALYTICS SNAPSHOT ───────────────────
+
+@app.post("/analytics/snapshot", tags=["Analytics"])
+async def analytics_snapshot(
+    full: bool = Query(default=False, description="Rebuild instead of appending new rows"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Refresh the Parquet snapshot now (it also refreshes every SNAPSHOT_INTERVAL_SEC)."""
+    return await refresh_snapshot(db, full=full)
+
+
+@app.get("/analytics/timeseries", tags=["Analytics"])
+async def analytics_timeseries(
+    metric: Literal["count", "avg_priority", "negative_share"] = "count",
+    bucket: Literal["hour", "day", "week", "month"] = "day",
+    by: Optional[Literal["ticket_type", "sentiment", "language", "segment", "office_name", "city"]] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+):
+    """Bucketed trends from the columnar snapshot — no Postgres load."""
+    loop = asyncio.get_event_loop()
+    result = await loop.run_in_executor(
+        None, snapshot_timeseries, metric, bucket, by, date_from, date_to
+    )
+    return ORJSONResponse({**result, "snapshot": snapshot_status()})
+
+
+@app.get("/analytics/managers", tags=["Analytics"])
+async def analytics_managers(
+    bucket: Optional[Literal["hour", "day", "week", "month"]] = None,
+    office: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+):
+    """Per-manager throughput, mean priority and negative share from the snapshot."""
+    loop = asyncio.get_event_loop()
+    result = await loop.run_in_executor(
+        None, snapshot_managers, bucket, office, date_from, date_to
+    )
+    return ORJSONResponse({**result, "snapshot": snapshot_status()})
+
+
+# ─────────────────── CAPACITY SIMULATION ───────────────────
+
+async def _read_upload(file: Optional[UploadFile], required: List[str]):
+    if file is None:
+        return None
+    try:
+        df = read_csv_bytes(await file.read())
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Failed to parse {file.filename}: {e}")
+    missing = [c for c in required if c not in df.columns]
+    if missing:
+        raise HTTPException(status_code=422, detail=f"{file.filename} must have columns: {', '.join(missing)}")
+    return df
+
+
+@app.post("/simulate", tags=["Analytics"])
+async def simulate_routing(
+    managers: Optional[UploadFile] = File(default=None, description="Scenario managers.csv"),
+    business_units: Optional[UploadFile] = File(
+        default=None, description="Scenario business_units.csv (optional lat/lon columns)"
+    ),
+    tickets: Optional[UploadFile] = File(
+        default=None, description="tickets.csv to replay; defaults to enriched tickets in the DB"
+    ),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    initial_workload: Literal["zero", "current"] = Query(
+        default="zero", description="Start from empty queues or the managers' current workload"
+    ),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """
+    Dry-run the routing cascade in memory: the current DB setup is the
+    baseline, uploaded CSVs replace managers / offices for the scenario.
+    Nothing is written.
+    """
+    mgr_df = await _read_upload(managers, ["ФИО", "Офис"])
+    bu_df = await _read_upload(business_units, ["Офис"])
+    tk_df = await _read_upload(tickets, ["GUID клиента"])
+
+    if tk_df is not None:
+        ticket_frame = await simulator.tickets_from_csv(db, tk_df)
+    else:
+        ticket_frame = await simulator.load_db_tickets(db, date_from, date_to)
+    db_managers = await simulator.load_db_managers(db)
+    db_offices = await simulator.load_db_offices(db)
+
+    scen_managers = simulator.managers_from_csv(mgr_df) if mgr_df is not None else db_managers
+    scen_offices = (
+        simulator.offices_from_csv(bu_df, db_offices) if bu_df is not None else db_offices
+    )
+    without_coords = scen_offices[scen_offices["lat"].isna()]["name"].tolist()
+
+    def run():
+        baseline = simulator.simulate(ticket_frame, db_managers, db_offices, initial_workload)
+        if mgr_df is None and bu_df is None:
+            return baseline, None, None
+        scenario = simulator.simulate(ticket_frame, scen_managers, scen_offices, initial_workload)
+        return baseline, scenario, simulator.diff_reports(baseline, scenario)
+
+    loop = asyncio.get_event_loop()
+    baseline, scenario, diff = await loop.run_in_executor(_executor, run)
+    return ORJSONResponse({
+        "baseline": baseline,
+        "scenario": scenario,
+        "diff": diff,
+        "offices_without_coordinates": without_coords,
+    })
+
+
+@app.get("/events", tags=["System"])
+async def events():
+    """
+    Server-Sent Events: `ticket` per processed ticket and periodic `stats_delta`
+    aggregates. Clients that fall behind get an `overflow` event and are
+    disconnected; reconnect and re-read /stats to resync.
+    """
+    return StreamingResponse(
+        broadcaster.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/admin/loop-lag", tags=["System"], dependencies=[Depends(require_admin)])
+async def admin_loop_lag():
+    return loop_lag.summary()
+
+
+@app.post(
+    "/admin/profile", tags=["System"],
+    response_class=PlainTextResponse, dependencies=[Depends(require_admin)],
+)
+async def admin_profile(seconds: float = Query(default=10.0, le=60.0, gt=0)):
+    """Sample every thread for `seconds`; returns collapsed stacks for flamegraph tools."""
+    loop = asyncio.get_event_loop()
+    # Own thread, not _executor, so a saturated pool cannot block the capture
+    return await loop.run_in_executor(None, sample_stacks, seconds)
+
+
 @app.get("/health", tags=["System"])
 async def health():
-    return {"status": "ok", "service": "ticket-routing"}
\ No newline at end of file
+    """503 while the startup warm-up is still running."""
+    if not warmup.state.ready:
+        return ORJSONResponse(
+            {"status": "warming", "service": "ticket-routing", "warmup": warmup.state.report()},
+            status_code=503,
+        )
+    return {"status": "ok", "service": "ticket-routing", "warmup": warmup.state.report()}
\ No newline at end of file
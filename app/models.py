@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, Text, DateTime, ForeignKey, ARRAY
+from sqlalchemy import Column, String, Integer, Float, Text, DateTime, ForeignKey, Boolean, ARRAY
 from sqlalchemy.orm import relationship, DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from datetime import datetime
@@ -16,6 +16,7 @@ class BusinessUnit(Base):
     address = Column(Text)
     lat = Column(Float, nullable=True)
     lon = Column(Float, nullable=True)
+    active = Column(Boolean, default=True, nullable=False, server_default="true")  # soft delete
 
     managers = relationship("Manager", back_populates="business_unit")
     tickets = relationship("Ticket", back_populates="office")
@@ -25,12 +26,13 @@ class Manager(Base):
     __tablename__ = "managers"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    full_name = Column(String(255), nullable=False)
+    full_name = Column(String(255), unique=True, nullable=False)
     position = Column(String(100))  # Специалист, Ведущий специалист, Главный специалист
     office_name = Column(String(255), ForeignKey("business_units.name"))
     skills = Column(Text)  # stored as comma-separated: VIP, ENG, KZ
     workload = Column(Integer, default=0)
     round_robin_index = Column(Integer, default=0)  # for RR tracking
+    active = Column(Boolean, default=True, nullable=False, server_default="true")  # soft delete
 
     business_unit = relationship("BusinessUnit", back_populates="managers")
     tickets = relationship("Ticket", back_populates="assigned_manager")
@@ -61,6 +63,12 @@ class Ticket(Base):
     geo_normalization = Column(Text)
     client_lat = Column(Float, nullable=True)
     client_lon = Column(Float, nullable=True)
+    analysis_source = Column(String(20), nullable=True)  # llm | fast (pre-classifier) | neardup
+    enriched_at = Column(DateTime, nullable=True)  # checkpoint: analysis persisted, not yet routed
+
+    # Retry bookkeeping
+    attempts = Column(Integer, default=0, nullable=False, server_default="0")
+    next_attempt_at = Column(DateTime, nullable=True)
 
     # Assignment
     office_name = Column(String(255), ForeignKey("business_units.name"), nullable=True)
@@ -68,6 +76,56 @@ class Ticket(Base):
 
     created_at = Column(DateTime, default=datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
+    # Set by the tickets_touch trigger on every write; analytics snapshot change feed
+    updated_at = Column(DateTime, nullable=True, index=True)
 
     office = relationship("BusinessUnit", back_populates="tickets")
-    assigned_manager = relationship("Manager", back_populates="tickets")
\ No newline at end of file
+    assigned_manager = relationship("Manager", back_populates="tickets")
+
+
+class DeadLetter(Base):
+    """Tickets that exhausted their retry budget, with the last error seen."""
+    __tablename__ = "dead_letters"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    ticket_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), unique=True, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(Text)
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
+    ticket = relationship("Ticket")
+
+
+class WorkerNode(Base):
+    """Heartbeats of worker nodes participating in office sharding."""
+    __tablename__ = "worker_nodes"
+
+    node_id = Column(String(100), primary_key=True)
+    last_seen = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class RosterVersion(Base):
+    """Single row bumped by every manager write outside shard batches; owners reload on change."""
+    __tablename__ = "roster_version"
+
+    id = Column(Integer, primary_key=True, default=1)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class OfficeLease(Base):
+    """Which node currently owns assignment for an office."""
+    __tablename__ = "office_leases"
+
+    office_name = Column(String(255), primary_key=True)
+    node_id = Column(String(100), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class DuplicateLink(Base):
+    """Audit trail: ticket whose analysis was inherited from a near-duplicate."""
+    __tablename__ = "duplicate_links"
+
+    ticket_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), primary_key=True)
+    representative_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), nullable=False)
+    similarity = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,354 @@
+"""
+Near-duplicate detection for ticket descriptions (MinHash + LSH).
+
+Descriptions are normalised, cut into character shingles and summarised
+by a NUM_PERM-value MinHash signature. Signatures are banded into LSH
+buckets, so candidates come from a few dict lookups rather than a scan.
+A candidate is accepted when its estimated Jaccard similarity reaches
+SIMILARITY_THRESHOLD, and the new ticket then inherits the analysis of
+the candidate's cluster representative instead of calling the LLM.
+
+The index lives in memory, supports incremental inserts and is saved to
+NEARDUP_INDEX_FILE as a plain .npz (signatures, cluster links, analyses
+as JSON) — no pickle, so loading a tampered file cannot run code. It is
+loaded (or rebuilt from the DB) in the background at startup and saved
+every NEARDUP_SAVE_INTERVAL_SEC when it has changed.
+Benchmark: python -m app.neardup --bench 1000000
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+NUM_PERM = 64
+BANDS = 8                      # 8 bands × 8 rows → LSH knee at J ≈ 0.77
+ROWS = NUM_PERM // BANDS
+SHINGLE = 5
+SIMILARITY_THRESHOLD = float(os.getenv("NEARDUP_THRESHOLD", "0.85"))
+MIN_TEXT_CHARS = 40            # too short to be a meaningful template
+MAX_BUCKET = 64                # a full bucket already matches its wave; keeps lookups O(1)
+STATE_DIR = os.getenv(
+    "STATE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "state")
+)
+INDEX_FILE = os.getenv("NEARDUP_INDEX_FILE", os.path.join(STATE_DIR, "neardup_index.npz"))
+SAVE_INTERVAL_SEC = float(os.getenv("NEARDUP_SAVE_INTERVAL_SEC", "300"))
+
+_PRIME = (1 << 61) - 1
+_MASK32 = (1 << 32) - 1
+
+
+def _params():
+    import numpy as np
+
+    rng = np.random.default_rng(0x5EED)   # fixed so persisted signatures stay comparable
+    a = rng.integers(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+    return a, b
+
+
+_A = _B = None
+
+
+def normalize(text: str) -> str:
+    t = (text or "").lower().replace("ё", "е")
+    t = re.sub(r"https?://\S+", " url ", t)
+    t = re.sub(r"\d+", "0", t)            # amounts, dates, card tails differ per copy
+    t = re.sub(r"[^\w ]+", " ", t)
+    return re.sub(r"\s+", " ", t).strip()
+
+
+def signature(text: str):
+    """MinHash signature (uint32[NUM_PERM]) or None if the text is too short."""
+    import numpy as np
+
+    global _A, _B
+    if _A is None:
+        _A, _B = _params()
+    t = normalize(text)
+    if len(t) < MIN_TEXT_CHARS:
+        return None
+    shingles = {t[i:i + SHINGLE] for i in range(len(t) - SHINGLE + 1)}
+    h = np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+    )
+    # (a·h + b) mod p, min over shingles; a, b < 2^31 and h < 2^32 keep this inside uint64
+    mh = ((_A[:, None] * h[None, :] + _B[:, None]) % np.uint64(_PRIME)).min(axis=1)
+    return (mh & np.uint64(_MASK32)).astype(np.uint32)
+
+
+def _band_keys(sig) -> List[bytes]:
+    return [bytes([i]) + sig[i * ROWS:(i + 1) * ROWS].tobytes() for i in range(BANDS)]
+
+
+class NearDupIndex:
+    """
+    Signatures live in one contiguous uint32 matrix (row per ticket), so a
+    query compares all of its LSH candidates in a single vectorised step.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        self._generation = 0   # bumped by clear(); a slower load must not resurrect old state
+        self.loaded = False    # until then a save would overwrite the file with a partial index
+        self.dirty = False
+        self.hits = 0
+        self.lookups = 0
+
+    def _reset(self):
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(BANDS)]  # → rows
+        self._mat = None   # allocated on first insert so importing stays numpy-free
+        self._ids: List[int] = []                          # row → ticket id
+        self._row_of: Dict[int, int] = {}                  # ticket id → row
+        self._rep_of: Dict[int, int] = {}                  # ticket id → representative id
+        self._analysis: Dict[int, Dict[str, Any]] = {}     # representative id → result dict
+
+    def __len__(self):
+        return len(self._ids)
+
+    def query(self, sig) -> Optional[Tuple[int, float, Dict[str, Any]]]:
+        """Best representative above threshold: (rep_id, similarity, analysis)."""
+        import numpy as np
+
+        if sig is None:
+            return None
+        with self._lock:
+            self.lookups += 1
+            cands = set()
+            for band, key in enumerate(_band_keys(sig)):
+                cands.update(self._buckets[band].get(key, ()))
+            if not cands:
+                return None
+            rows = np.fromiter(cands, dtype=np.int64, count=len(cands))
+            sims = (self._mat[rows] == sig).mean(axis=1)
+            best = int(sims.argmax())
+            if sims[best] < SIMILARITY_THRESHOLD:
+                return None
+            cand_id = self._ids[rows[best]]
+            rep = self._rep_of.get(cand_id, cand_id)
+            analysis = self._analysis.get(rep)
+            if analysis is None:
+                return None
+            self.hits += 1
+            return rep, float(sims[best]), dict(analysis)
+
+    def _insert(self, ticket_id: int, sig):
+        import numpy as np
+
+        row = len(self._ids)
+        if self._mat is None:
+            self._mat = np.empty((1024, NUM_PERM), dtype=np.uint32)
+        elif row == len(self._mat):
+            grown = np.empty((2 * len(self._mat), NUM_PERM), dtype=np.uint32)
+            grown[:row] = self._mat
+            self._mat = grown
+        self._mat[row] = sig
+        self._ids.append(ticket_id)
+        self._row_of[ticket_id] = row
+        for band, key in enumerate(_band_keys(sig)):
+            bucket = self._buckets[band].setdefault(key, [])
+            if len(bucket) < MAX_BUCKET:
+                bucket.append(row)
+
+    def add(self, ticket_id: int, sig, analysis: Optional[Dict[str, Any]] = None,
+            representative: Optional[int] = None):
+        """Insert a ticket. With `analysis` it becomes a representative;
+        with `representative` it joins that cluster."""
+        if sig is None:
+            return
+        with self._lock:
+            if ticket_id in self._row_of:
+                return
+            self._insert(ticket_id, sig)
+            self.dirty = True
+            if representative is not None and representative != ticket_id:
+                self._rep_of[ticket_id] = representative
+            elif analysis is not None:
+                self._analysis[ticket_id] = dict(analysis)
+
+    def clear(self):
+        """Drop every signature and cluster, e.g. after the tickets table was replaced."""
+        with self._lock:
+            self._reset()
+            self._generation += 1
+            self.dirty = True
+
+    def discard(self, representative: int):
+        """Stop matching a cluster whose representative ticket no longer exists."""
+        with self._lock:
+            if self._analysis.pop(representative, None) is not None:
+                self.dirty = True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "indexed": len(self._ids),
+            "representatives": len(self._analysis),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else None,
+        }
+
+    # ── persistence ──────────────────────────────────────────────────────────
+
+    def save(self, path: str = INDEX_FILE):
+        import numpy as np
+
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        with self._lock:
+            n = len(self._ids)
+            arrays = {
+                "ids": np.asarray(self._ids, dtype=np.int64),
+                "sigs": (
+                    self._mat[:n].copy() if n else np.empty((0, NUM_PERM), dtype=np.uint32)
+                ),
+                "rep_from": np.fromiter(self._rep_of.keys(), dtype=np.int64, count=len(self._rep_of)),
+                "rep_to": np.fromiter(self._rep_of.values(), dtype=np.int64, count=len(self._rep_of)),
+                "analysis": np.frombuffer(json.dumps(
+                    {str(k): v for k, v in self._analysis.items()}, ensure_ascii=False,
+                ).encode("utf-8"), dtype=np.uint8),
+            }
+            self.dirty = False
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+        except Exception:
+            self.dirty = True
+            raise
+
+    def load(self, path: str = INDEX_FILE) -> bool:
+        import numpy as np
+
+        if not os.path.exists(path):
+            return False
+        generation = self._generation
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                ids, sigs = z["ids"], z["sigs"]
+                rep_of = dict(zip(z["rep_from"].tolist(), z["rep_to"].tolist()))
+                analysis = {int(k): v for k, v in json.loads(z["analysis"].tobytes()).items()}
+            if sigs.shape != (len(ids), NUM_PERM):
+                raise ValueError(f"signature shape {sigs.shape} does not match NUM_PERM={NUM_PERM}")
+        except Exception as e:
+            print(f"Could not load near-duplicate index: {e}")
+            return False
+        # Built aside and swapped in, so queries are not blocked while it loads
+        fresh = NearDupIndex()
+        # Re-inserting in saved order reproduces the capped buckets
+        for ticket_id, sig in zip(ids.tolist(), sigs):
+            fresh._insert(ticket_id, sig)
+        with self._lock:
+            if self._generation != generation:
+                return False
+            self._buckets, self._mat = fresh._buckets, fresh._mat
+            self._ids, self._row_of = fresh._ids, fresh._row_of
+            self._rep_of, self._analysis = rep_of, analysis
+            self.dirty = False
+        return True
+
+
+index = NearDupIndex()
+
+
+async def build_from_db(db, limit: int = 200_000, executor=None) -> int:
+    """Seed an empty index from the most recent LLM-analysed tickets; hashing runs in `executor`."""
+    from sqlalchemy import select
+    from app.models import Ticket
+
+    rows = (await db.execute(
+        select(
+            Ticket.id, Ticket.description, Ticket.ticket_type, Ticket.sentiment,
+            Ticket.priority, Ticket.language, Ticket.summary,
+        )
+        .where(Ticket.enriched_at.isnot(None), Ticket.analysis_source == "llm")
+        .order_by(Ticket.id.desc())
+        .limit(limit)
+    )).all()
+
+    def seed():
+        for r in rows:
+            index.add(r.id, signature(r.description or ""), {
+                "type": r.ticket_type, "sentiment": r.sentiment, "priority": r.priority,
+                "language": r.language, "summary": r.summary,
+            })
+
+    await asyncio.get_event_loop().run_in_executor(executor, seed)
+    return len(rows)
+
+
+async def warm(factory, executor=None) -> int:
+    """Startup: load the saved index, or rebuild it from the DB when there is none."""
+    loop = asyncio.get_event_loop()
+    if await loop.run_in_executor(executor, index.load):
+        n = len(index)
+    else:
+        async with factory() as db:
+            n = await build_from_db(db, executor=executor)
+    index.loaded = True
+    return n
+
+
+async def save_loop(interval: float = SAVE_INTERVAL_SEC):
+    """Background task: persist the index when it has changed since the last save."""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if index.loaded and index.dirty:
+            try:
+                await loop.run_in_executor(None, index.save)
+            except Exception as e:
+                print(f"Near-duplicate index save failed: {e}")
+
+
+# ── Benchmark ─────────────────────────────────────────────────────────────────
+
+def _bench(n: int):
+    import random
+    import time
+
+    templates = [
+        "Здравствуйте, у меня не работает приложение, при входе выдает ошибку {x}, прошу помочь срочно",
+        "Добрый день. С моей карты списали {x} тенге без моего ведома, прошу вернуть деньги и заблокировать",
+        "Поздравляем! Вы выиграли {x} бонусов, переходите по ссылке и получите подарок прямо сейчас",
+        "Не могу вывести средства со счета уже {x} дней, поддержка не отвечает, буду писать жалобу",
+    ]
+    words = "акции брокер счет перевод комиссия отчет налог договор паспорт адрес".split()
+    rnd = random.Random(1)
+    idx = NearDupIndex()
+
+    t0 = time.perf_counter()
+    sigs = []
+    for i in range(n):
+        if rnd.random() < 0.5:
+            text = rnd.choice(templates).format(x=rnd.randint(1, 99999))
+        else:
+            text = " ".join(rnd.choice(words) for _ in range(rnd.randint(12, 40))) + f" {i}"
+        sigs.append(signature(text))
+    t1 = time.perf_counter()
+
+    hits = 0
+    for i, sig in enumerate(sigs):
+        m = idx.query(sig)
+        if m is not None:
+            hits += 1
+            idx.add(i, sig, representative=m[0])
+        else:
+            idx.add(i, sig, analysis={"type": "Консультация"})
+    t2 = time.perf_counter()
+
+    print(f"{n} descriptions")
+    print(f"signatures: {t1 - t0:.1f}s ({(t1 - t0) / n * 1e6:.0f} µs/doc)")
+    print(f"query+insert: {t2 - t1:.1f}s ({(t2 - t1) / n * 1e6:.0f} µs/doc)")
+    print(f"near-duplicate hits: {hits} ({hits / n:.1%})")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    p = argparse.ArgumentParser(description="Near-duplicate index benchmark")
+    p.add_argument("--bench", type=int, default=1_000_000, help="number of synthetic descriptions")
+    _bench(p.parse_args().bench)
@@ -0,0 +1,248 @@
+"""
+Local CPU-only pre-classifier that runs before llm_analyze_ticket.
+
+Obvious tickets — empty text, spam, bare greetings — get the same result
+dict shape as the LLM immediately; everything else returns None and goes
+to the model. Language is detected by script plus character trigram
+profiles; spam by rules plus a naive Bayes model over trigrams. Both are
+calibrated on stored Ticket.language / Ticket.ticket_type labels.
+"""
+import asyncio
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, Any, NamedTuple, Optional, Tuple, List
+
+from sqlalchemy import select, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Ticket
+
+SPAM_THRESHOLD = 0.95        # min spam probability to skip the LLM
+LANG_THRESHOLD = 0.85        # min language confidence to skip the LLM
+GREETING_MAX_WORDS = 4
+KZ_CHAR_RATIO = 0.06         # share of Kazakh-specific letters among Cyrillic ones
+CALIBRATION_MAX_ROWS = int(os.getenv("PRECLASSIFIER_MAX_ROWS", "20000"))
+
+_KZ_CHARS = set("әғқңөұүһіӘҒҚҢӨҰҮҺІ")
+_CYR_RE = re.compile(r"[а-яёА-ЯЁәғқңөұүһіӘҒҚҢӨҰҮҺІ]")
+_LAT_RE = re.compile(r"[a-zA-Z]")
+_WORD_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+_SPAM_RULES = [
+    re.compile(p, re.IGNORECASE) for p in (
+        r"https?://", r"www\.", r"t\.me/", r"\bскидк", r"\bрозыгрыш", r"\bвыигр",
+        r"\bзаработ", r"\bподписывайтесь", r"\bпромокод", r"\bказино", r"\bставк",
+        r"\bcasino\b", r"\bpromo\b", r"\bdiscount\b", r"\bunsubscribe\b",
+    )
+]
+
+_GREETINGS = {
+    "здравствуйте", "привет", "добрый", "день", "вечер", "утро", "доброе",
+    "hello", "hi", "hey", "good", "morning", "afternoon", "evening",
+    "сәлем", "сәлеметсіз", "сәлеметсізбе", "бе", "қайырлы", "күн",
+    "спасибо", "рахмет", "thanks", "thank", "you",
+}
+
+_GREETING_SUMMARY = {
+    "RU": "Клиент отправил только приветствие без сути вопроса. Запросить у клиента подробности обращения.",
+    "KZ": "Клиент тек сәлемдесу жіберді, өтініштің мәні жоқ. Клиенттен өтініш туралы толығырақ сұрау керек.",
+    "ENG": "The client sent only a greeting without describing the issue. Ask the client for details of the request.",
+}
+
+
+def _trigrams(text: str) -> List[str]:
+    t = " " + re.sub(r"\s+", " ", text.lower()).strip() + " "
+    return [t[i:i + 3] for i in range(len(t) - 2)]
+
+
+# ── Calibrated state (populated by calibrate()) ───────────────────────────────
+
+class Model(NamedTuple):
+    """Everything calibrate() fits; replaced as a whole so readers never mix two fits."""
+    lang_profiles: Dict[str, Counter]
+    spam_counts: Dict[bool, Counter]
+    spam_totals: Dict[bool, int]
+    spam_prior: Dict[bool, float]
+    vocab_size: int
+
+
+_model = Model({}, {}, {}, {}, 1)
+
+stats = Counter()           # fast / llm counters for the API-call rate
+last_eval: Dict[str, Any] = {}
+
+
+# ── Language ──────────────────────────────────────────────────────────────────
+
+def detect_language(text: str, model: Optional[Model] = None) -> Tuple[str, float]:
+    """Return (KZ|ENG|RU, confidence)."""
+    cyr = len(_CYR_RE.findall(text))
+    lat = len(_LAT_RE.findall(text))
+    letters = cyr + lat
+    if letters == 0:
+        return "RU", 0.5
+    # A Kazakh place name or surname in Russian text must not flip the language
+    kz = sum(1 for ch in text if ch in _KZ_CHARS)
+    if cyr and kz / cyr >= KZ_CHAR_RATIO:
+        return "KZ", 0.97
+    if lat / letters > 0.8:
+        return "ENG", 0.95 if letters >= 8 else 0.9
+
+    # Cyrillic without Kazakh-specific letters is RU unless the calibrated
+    # n-gram profiles clearly prefer another language (e.g. KZ typed in RU layout)
+    profiles = (model or _model).lang_profiles
+    if profiles:
+        grams = Counter(_trigrams(text))
+        scores = {l: _cosine(grams, p) for l, p in profiles.items()}
+        best = max(scores, key=scores.get)
+        if best != "RU" and scores[best] > 1.2 * scores.get("RU", 0.0):
+            return best, 0.7
+    if kz:
+        return "RU", 0.7   # mixed signal: let the model decide
+    return "RU", 0.9
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    dot = sum(v * b.get(k, 0) for k, v in a.items())
+    na = math.sqrt(sum(v * v for v in a.values()))
+    nb = math.sqrt(sum(v * v for v in b.values()))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+# ── Spam ──────────────────────────────────────────────────────────────────────
+
+def spam_probability(text: str, model: Optional[Model] = None) -> float:
+    """Rule hits and the trigram naive Bayes posterior, combined as a noisy-OR."""
+    m = model or _model
+    hits = sum(1 for r in _SPAM_RULES if r.search(text))
+    rule_p = 1.0 - 0.3 ** hits
+    if not m.spam_counts or not m.spam_totals.get(True):
+        return rule_p
+
+    logp = {}
+    for label in (True, False):
+        counts, total = m.spam_counts[label], m.spam_totals[label]
+        lp = math.log(m.spam_prior[label])
+        for g in _trigrams(text):
+            lp += math.log((counts.get(g, 0) + 1) / (total + m.vocab_size))
+        logp[label] = lp
+    diff = max(-50.0, min(50.0, logp[False] - logp[True]))
+    nb_p = 1.0 / (1.0 + math.exp(diff))
+    return 1.0 - (1.0 - rule_p) * (1.0 - nb_p)
+
+
+# ── Entry point ───────────────────────────────────────────────────────────────
+
+def preclassify(text: str, model: Optional[Model] = None) -> Optional[Dict[str, Any]]:
+    """Return an LLM-shaped result for high-confidence tickets, else None."""
+    text = (text or "").strip()
+    if not text:
+        return None  # llm_analyze_ticket already short-circuits empty text
+
+    m = model or _model   # one fit for the whole decision
+    lang, lang_conf = detect_language(text, m)
+    if lang_conf < LANG_THRESHOLD:
+        return None
+
+    words = [w.lower() for w in _WORD_RE.findall(text)]
+    if words and len(words) <= GREETING_MAX_WORDS and all(w in _GREETINGS for w in words):
+        return {
+            "type": "Консультация",
+            "sentiment": "Нейтральный",
+            "priority": 3,
+            "language": lang,
+            "summary": _GREETING_SUMMARY[lang],
+        }
+
+    if spam_probability(text, m) >= SPAM_THRESHOLD:
+        return {
+            "type": "Спам",
+            "sentiment": "Нейтральный",
+            "priority": 1,
+            "language": lang,
+            "summary": "Рекламное или нерелевантное сообщение. Действий не требуется.",
+        }
+    return None
+
+
+# ── Calibration against stored labels ─────────────────────────────────────────
+
+def _fit(rows: List[Tuple[str, str, str]]) -> Model:
+    profiles: Dict[str, Counter] = {}
+    counts = {True: Counter(), False: Counter()}
+    docs = Counter()
+    for desc, ttype, lang in rows:
+        grams = _trigrams(desc)
+        if lang:
+            profiles.setdefault(lang, Counter()).update(grams)
+        is_spam = ttype == "Спам"
+        counts[is_spam].update(grams)
+        docs[is_spam] += 1
+    n = max(1, sum(docs.values()))
+    return Model(
+        lang_profiles=profiles,
+        spam_counts=counts,
+        spam_totals={k: sum(v.values()) for k, v in counts.items()},
+        spam_prior={k: (docs[k] + 1) / (n + 2) for k in (True, False)},
+        vocab_size=max(1, len(set(counts[True]) | set(counts[False]))),
+    )
+
+
+def evaluate(rows: List[Tuple[str, str, str]], model: Optional[Model] = None) -> Dict[str, Any]:
+    """Coverage and accuracy of the fast path (and language detector) on labelled rows."""
+    fast = type_ok = lang_ok = lang_all_ok = 0
+    for desc, ttype, lang in rows:
+        if detect_language(desc, model)[0] == lang:
+            lang_all_ok += 1
+        res = preclassify(desc, model)
+        if res is None:
+            continue
+        fast += 1
+        type_ok += res["type"] == ttype
+        lang_ok += res["language"] == lang
+    n = len(rows)
+    return {
+        "samples": n,
+        "fast_path_rate": fast / n if n else 0.0,
+        "fast_path_type_accuracy": type_ok / fast if fast else None,
+        "fast_path_language_accuracy": lang_ok / fast if fast else None,
+        "language_accuracy": lang_all_ok / n if n else None,
+    }
+
+
+def _fit_and_evaluate(rows: List[Tuple[int, str, str, str]]) -> Dict[str, Any]:
+    """Runs in an executor thread; the live model changes in one assignment at the end."""
+    global _model
+    train = [r[1:] for r in rows if r[0] % 5]
+    hold = [r[1:] for r in rows if not r[0] % 5]
+    evaluation = evaluate(hold, _fit(train))
+    _model = _fit([r[1:] for r in rows])
+    return evaluation
+
+
+async def calibrate(db: AsyncSession, executor=None) -> Dict[str, Any]:
+    """
+    Fit on the most recent CALIBRATION_MAX_ROWS LLM-labelled tickets
+    (fast-path and inherited near-duplicate outputs are excluded to avoid
+    feedback), report held-out accuracy on every 5th ticket, then refit on
+    all. The CPU-bound fit runs in `executor`, off the event loop.
+    """
+    global last_eval
+    result = await db.execute(
+        select(Ticket.id, Ticket.description, Ticket.ticket_type, Ticket.language)
+        .where(
+            Ticket.ticket_type.isnot(None),
+            Ticket.description.isnot(None),
+            or_(Ticket.analysis_source.is_(None), Ticket.analysis_source == "llm"),
+        )
+        .order_by(Ticket.id.desc())
+        .limit(CALIBRATION_MAX_ROWS)
+    )
+    rows = [(r.id, r.description.strip(), r.ticket_type, r.language) for r in result]
+    rows = [r for r in rows if r[1]]
+
+    loop = asyncio.get_event_loop()
+    last_eval = await loop.run_in_executor(executor, _fit_and_evaluate, rows)
+    return last_eval
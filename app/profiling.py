@@ -0,0 +1,150 @@
+"""
+Opt-in profiling surface. Everything here is inert unless ADMIN_TOKEN is set.
+
+- Per-request profiling: send `X-Profile: 1` and `X-Admin-Token: <token>`
+  and the response is replaced by a pyinstrument HTML report.
+- Event-loop lag monitor: a background task that measures how late the
+  loop wakes up from a fixed sleep (PROFILE_LOOP_LAG=1 to enable).
+- Worker capture: sample every thread's stack for a bounded duration and
+  return collapsed stacks (flamegraph.pl / speedscope input).
+"""
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, Optional
+
+from fastapi import HTTPException, Request
+from starlette.responses import HTMLResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+LOOP_LAG_ENABLED = os.getenv("PROFILE_LOOP_LAG", "0") == "1"
+LOOP_LAG_INTERVAL_SEC = 0.5
+MAX_CAPTURE_SEC = 60.0
+# Streaming responses: /events never ends, exports are too large to buffer
+UNPROFILED_PATHS = frozenset({"/events", "/tickets/export"})
+
+
+def is_admin(token: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+def require_admin(request: Request):
+    """FastAPI dependency for admin-only endpoints."""
+    if not is_admin(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+# ── Per-request profiling ─────────────────────────────────────────────────────
+
+class RequestProfilerMiddleware:
+    """
+    Pure ASGI so the disabled path is a couple of comparisons per request;
+    headers are only inspected when ADMIN_TOKEN is configured.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not ADMIN_TOKEN or scope["type"] != "http" or scope["path"] in UNPROFILED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-admin-token", b"").decode("latin-1")
+        if headers.get(b"x-profile") != b"1" or not is_admin(token):
+            await self.app(scope, receive, send)
+            return
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            await self.app(scope, receive, send)
+            return
+
+        async def discard(message: Message):
+            pass   # the report replaces the response; body is still produced while profiled
+
+        profiler = Profiler(async_mode="enabled", interval=0.001)
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+        await HTMLResponse(profiler.output_html())(scope, receive, send)
+
+
+# ── Event-loop lag ────────────────────────────────────────────────────────────
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SEC, window: int = 1200):
+        self.interval = interval
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self._samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        if not self._samples:
+            return {"enabled": self._task is not None, "samples": 0}
+        s = sorted(self._samples)
+        return {
+            "enabled": self._task is not None,
+            "samples": len(s),
+            "last_ms": self._samples[-1] * 1000,
+            "p50_ms": s[len(s) // 2] * 1000,
+            "p99_ms": s[min(len(s) - 1, int(len(s) * 0.99))] * 1000,
+            "max_ms": s[-1] * 1000,
+        }
+
+
+loop_lag = LoopLagMonitor()
+
+
+# ── Whole-process stack sampling ──────────────────────────────────────────────
+
+def _collapse(frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """
+    Sample all threads (event loop + executor workers) for `seconds` and
+    return collapsed stacks, one `stack count` line per unique stack.
+    Blocking — run it in a thread.
+    """
+    seconds = min(max(0.1, seconds), MAX_CAPTURE_SEC)
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            counts[f"{names.get(ident, ident)};{_collapse(frame)}"] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
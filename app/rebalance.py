@@ -0,0 +1,119 @@
+"""
+Routing-only rebalancing for already-enriched tickets.
+
+Re-runs the geography + competency + workload steps of the cascade from the
+stored ticket_type / language / client_lat / client_lon — no LLM and no
+geocoding — for every affected ticket in one transaction, and reports
+which tickets moved.
+"""
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Ticket, Manager, BusinessUnit
+from app.httpcache import data_versions
+from app.routing import bump_roster_version, choose_office, needs_fallback, pick_manager
+
+
+async def rebalance_tickets(
+    db: AsyncSession,
+    scope: str = "orphaned",
+    office: Optional[str] = None,
+) -> Dict:
+    """
+    scope="orphaned": processed tickets with no live (active) manager or office.
+    scope="office":   processed tickets currently routed to `office`.
+    scope="all":      every processed ticket.
+
+    Tickets routed by the 50/50 fallback keep their office while it is
+    still active; re-running the toggle would only swap Астана and Алматы.
+    """
+    # First lock taken, so shard batches (roster row, then managers) can't deadlock with us
+    await bump_roster_version(db)
+    live_managers = select(Manager.id).where(Manager.active.is_(True))
+    live_offices = select(BusinessUnit.name).where(BusinessUnit.active.is_(True))
+
+    q = select(Ticket).where(Ticket.processed_at.isnot(None))
+    if scope == "orphaned":
+        q = q.where(or_(
+            Ticket.manager_id.is_(None),
+            Ticket.manager_id.notin_(live_managers),
+            Ticket.office_name.is_(None),
+            Ticket.office_name.notin_(live_offices),
+        ))
+    elif scope == "office":
+        q = q.where(Ticket.office_name == office)
+    q = q.order_by(Ticket.priority.desc().nullslast(), Ticket.id)
+    tickets = (await db.execute(q)).scalars().all()
+    active_offices = set((await db.execute(live_offices)).scalars().all())
+
+    # Offices first (no DB), so only the managers involved get locked
+    new_offices = []
+    for t in tickets:
+        if t.office_name in active_offices and needs_fallback(t, t.client_lat, t.client_lon):
+            new_offices.append(t.office_name)
+        else:
+            new_offices.append(await choose_office(t, t.client_lat, t.client_lon))
+
+    # Target offices' managers plus the current holders, locked in id order —
+    # the same order assign_manager_atomic uses, so the two cannot deadlock
+    old_ids = {t.manager_id for t in tickets if t.manager_id is not None}
+    managers = (await db.execute(
+        select(Manager)
+        .where(or_(Manager.office_name.in_(set(new_offices)), Manager.id.in_(old_ids)))
+        .order_by(Manager.id)
+        .with_for_update()
+    )).scalars().all() if tickets else []
+    by_id = {m.id: m for m in managers}
+    by_office: Dict[str, List[Manager]] = {}
+    for m in managers:
+        if m.active:
+            by_office.setdefault(m.office_name, []).append(m)
+
+    changes = []
+    ticket_rows = []
+    unassigned = 0
+    for t, new_office in zip(tickets, new_offices):
+        old_manager, old_office = t.manager_id, t.office_name
+
+        # Release the slot held on a still-existing manager before re-picking
+        prev = by_id.get(old_manager)
+        if prev is not None:
+            prev.workload = max(0, (prev.workload or 0) - 1)
+
+        chosen = pick_manager(
+            by_office.get(new_office, []), t.segment or "Mass",
+            t.ticket_type, t.language,
+        )
+        new_manager = chosen.id if chosen else None
+        if new_manager is None:
+            unassigned += 1
+
+        if (new_manager, new_office) != (old_manager, old_office):
+            changes.append({
+                "ticket_id": t.id,
+                "old_office": old_office,
+                "new_office": new_office,
+                "old_manager_id": old_manager,
+                "new_manager_id": new_manager,
+            })
+        ticket_rows.append({"id": t.id, "office_name": new_office, "manager_id": new_manager})
+
+    # Bulk UPDATE ... WHERE id = :id (executemany) instead of per-row flushes
+    if ticket_rows:
+        await db.execute(update(Ticket), ticket_rows)
+    if managers:
+        await db.execute(update(Manager), [
+            {"id": m.id, "workload": m.workload, "round_robin_index": m.round_robin_index}
+            for m in managers
+        ])
+    await db.commit()
+    data_versions.bump("tickets", "managers")
+
+    return {
+        "examined": len(tickets),
+        "reassigned": len(changes),
+        "unassigned": unassigned,
+        "changes": changes,
+    }
@@ -0,0 +1,72 @@
+"""
+Retry budget for the enrichment pipeline.
+
+A failing ticket is re-eligible after an exponentially growing delay;
+after MAX_ATTEMPTS it is parked in the dead_letters table and excluded
+from the backlog until explicitly requeued.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Ticket, DeadLetter
+
+MAX_ATTEMPTS = 5
+BASE_DELAY_SEC = 60
+MAX_DELAY_SEC = 6 * 3600
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(MAX_DELAY_SEC, BASE_DELAY_SEC * 2 ** max(0, attempts - 1)))
+
+
+def eligible_clause(now: datetime):
+    """WHERE clause for tickets that may be attempted now."""
+    return (
+        Ticket.attempts < MAX_ATTEMPTS,
+        or_(Ticket.next_attempt_at.is_(None), Ticket.next_attempt_at <= now),
+    )
+
+
+async def record_failure(db: AsyncSession, ticket_id: int, error: str) -> bool:
+    """Bump the attempt counter; dead-letter the ticket when the budget is spent.
+    Returns True if the ticket was dead-lettered."""
+    now = datetime.utcnow()
+    async with db.begin():
+        t = await db.get(Ticket, ticket_id, with_for_update=True)
+        if t is None:
+            return False
+        t.attempts = (t.attempts or 0) + 1
+        t.next_attempt_at = now + retry_delay(t.attempts)
+        if t.attempts < MAX_ATTEMPTS:
+            return False
+
+        existing = (await db.execute(
+            select(DeadLetter).where(DeadLetter.ticket_id == ticket_id)
+        )).scalar_one_or_none()
+        if existing is None:
+            db.add(DeadLetter(
+                ticket_id=ticket_id, attempts=t.attempts,
+                last_error=error[:4000], failed_at=now,
+            ))
+        else:
+            existing.attempts = t.attempts
+            existing.last_error = error[:4000]
+            existing.failed_at = now
+    return True
+
+
+async def requeue(db: AsyncSession, ticket_id: int) -> bool:
+    """Reset a dead-lettered ticket's budget so the next run picks it up."""
+    result = await db.execute(delete(DeadLetter).where(DeadLetter.ticket_id == ticket_id))
+    if not result.rowcount:
+        await db.rollback()
+        return False
+    await db.execute(
+        update(Ticket)
+        .where(Ticket.id == ticket_id)
+        .values(attempts=0, next_attempt_at=None)
+    )
+    await db.commit()
+    return True
@@ -7,10 +7,11 @@ Optimizations:
 - Fallback toggle uses asyncio.Lock only for the counter (not the whole write path)
 """
 import asyncio
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Set
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from app.models import Manager, BusinessUnit, Ticket
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.models import Manager, BusinessUnit, Ticket, RosterVersion
 from app.geo import haversine_km, is_kazakhstan
 
 # ── In-memory office cache (populated at startup) ─────────────────────────────
@@ -19,19 +20,27 @@ _fallback_toggle = 0
 _fallback_lock = asyncio.Lock()         # only guards the tiny toggle flip
 
 
-async def refresh_office_cache(db: AsyncSession):
-    """Call once at startup to load office coords into memory."""
+async def refresh_office_cache(db: AsyncSession, offices: Optional[Set[str]] = None):
+    """
+    Load office coords into memory. Called once at startup; after a sync,
+    pass `offices` to refresh only those entries.
+    """
     global _office_cache
-    result = await db.execute(
-        select(BusinessUnit).where(
-            BusinessUnit.lat.isnot(None),
-            BusinessUnit.lon.isnot(None),
-        )
+    q = select(BusinessUnit).where(
+        BusinessUnit.lat.isnot(None),
+        BusinessUnit.lon.isnot(None),
+        BusinessUnit.active.is_(True),
     )
-    _office_cache = [
+    if offices is not None:
+        q = q.where(BusinessUnit.name.in_(offices))
+    fresh = [
         {"name": o.name, "lat": o.lat, "lon": o.lon}
-        for o in result.scalars().all()
+        for o in (await db.execute(q)).scalars().all()
     ]
+    if offices is None:
+        _office_cache = fresh
+    else:
+        _office_cache = [o for o in _office_cache if o["name"] not in offices] + fresh
 
 
 def find_nearest_office_cached(clat: float, clon: float) -> Optional[str]:
@@ -82,41 +91,99 @@ async def assign_manager_atomic(
     Fetch all eligible managers for the office, pick the one with lowest workload
     (round-robin among ties), and atomically increment their workload in the same
     transaction using FOR UPDATE — so concurrent sessions won't double-assign.
+    Locked rows are waited for, in id order: skipping them would look like an
+    office with no capacity and leave the ticket without a manager.
     """
     result = await db.execute(
         select(Manager)
-        .where(Manager.office_name == office_name)
-        .with_for_update(skip_locked=True)   # other sessions skip locked rows
+        .where(Manager.office_name == office_name, Manager.active.is_(True))
+        .order_by(Manager.id)
+        .with_for_update()
     )
     all_managers = result.scalars().all()
 
+    return pick_manager(all_managers, segment, ticket_type, language)
+
+
+async def bump_roster_version(db: AsyncSession) -> None:
+    """
+    Call inside any transaction that writes managers (uploads, rebalancing).
+    The row lock orders it against shard batches, which re-read the roster
+    when the version moved.
+    """
+    stmt = pg_insert(RosterVersion).values(id=1, version=1)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[RosterVersion.id],
+        set_={"version": RosterVersion.version + 1},
+    ))
+
+
+def pick_manager(
+    managers: List[Manager],
+    segment: str,
+    ticket_type: str,
+    language: str,
+) -> Optional[Manager]:
+    """
+    Choose the least-loaded eligible manager (round-robin among ties) and
+    bump their counters in place. Caller owns locking and persistence.
+    """
     eligible = [
-        m for m in all_managers
+        m for m in managers
         if manager_can_handle(m, segment, ticket_type, language)
     ]
     if not eligible:
         return None
 
-    eligible.sort(key=lambda m: (m.workload, m.round_robin_index))
+    eligible.sort(key=lambda m: (m.workload or 0, m.round_robin_index or 0))
     chosen = eligible[0]
-    chosen.workload += 1
-    chosen.round_robin_index += 1
-    db.add(chosen)
+    chosen.workload = (chosen.workload or 0) + 1
+    chosen.round_robin_index = (chosen.round_robin_index or 0) + 1
     return chosen
 
 
+async def fallback_office() -> str:
+    """Alternate Астана / Алматы for tickets without a usable location."""
+    global _fallback_toggle
+    async with _fallback_lock:
+        chosen = "Астана" if _fallback_toggle == 0 else "Алматы"
+        _fallback_toggle ^= 1
+    return chosen
+
+
+def needs_fallback(
+    ticket: Ticket,
+    client_lat: Optional[float],
+    client_lon: Optional[float],
+) -> bool:
+    """Foreign or unknown location: the office comes from the Астана / Алматы toggle."""
+    country = ticket.country or ""
+    city    = ticket.city    or ""
+    foreign_or_unknown = (not is_kazakhstan(country)) or (not city)
+    return foreign_or_unknown or client_lat is None or client_lon is None
+
+
+async def choose_office(
+    ticket: Ticket,
+    client_lat: Optional[float],
+    client_lon: Optional[float],
+) -> str:
+    """Geography step of the cascade: nearest office, or the 50/50 fallback."""
+    if needs_fallback(ticket, client_lat, client_lon):
+        return await fallback_office()
+    # Pure in-memory lookup — no lock, no DB
+    return find_nearest_office_cached(client_lat, client_lon) or await fallback_office()
+
+
 # ── Main assignment pipeline ──────────────────────────────────────────────────
 
-async def process_ticket_assignment(
-    db: AsyncSession,
+def apply_enrichment(
     ticket: Ticket,
     ai_result: Dict[str, Any],
     client_lat: Optional[float],
     client_lon: Optional[float],
     geo_normalization: str,
 ) -> Ticket:
-    global _fallback_toggle
-
     ticket.ticket_type     = ai_result["type"]
     ticket.sentiment       = ai_result["sentiment"]
     ticket.priority        = ai_result["priority"]
@@ -125,33 +192,31 @@ async def process_ticket_assignment(
     ticket.geo_normalization = geo_normalization
     ticket.client_lat      = client_lat
     ticket.client_lon      = client_lon
+    return ticket
 
-    country = ticket.country or ""
-    city    = ticket.city    or ""
-    foreign_or_unknown = (not is_kazakhstan(country)) or (not city)
-
-    chosen_office: Optional[str] = None
-
-    if foreign_or_unknown or client_lat is None or client_lon is None:
-        # 50/50 fallback — only this tiny section needs a lock
-        async with _fallback_lock:
-            chosen_office = "Астана" if _fallback_toggle == 0 else "Алматы"
-            _fallback_toggle ^= 1
-    else:
-        # Pure in-memory lookup — no lock, no DB
-        chosen_office = find_nearest_office_cached(client_lat, client_lon)
-        if chosen_office is None:
-            async with _fallback_lock:
-                chosen_office = "Астана" if _fallback_toggle == 0 else "Алматы"
-                _fallback_toggle ^= 1
 
+async def assign_ticket(db: AsyncSession, ticket: Ticket) -> Ticket:
+    """Route an already-enriched ticket from its stored analysis fields."""
+    chosen_office = await choose_office(ticket, ticket.client_lat, ticket.client_lon)
     ticket.office_name = chosen_office
 
     manager = await assign_manager_atomic(
         db, chosen_office, ticket.segment or "Mass",
-        ai_result["type"], ai_result["language"]
+        ticket.ticket_type, ticket.language
     )
     if manager:
         ticket.manager_id = manager.id
 
-    return ticket
\ No newline at end of file
+    return ticket
+
+
+async def process_ticket_assignment(
+    db: AsyncSession,
+    ticket: Ticket,
+    ai_result: Dict[str, Any],
+    client_lat: Optional[float],
+    client_lon: Optional[float],
+    geo_normalization: str,
+) -> Ticket:
+    apply_enrichment(ticket, ai_result, client_lat, client_lon, geo_normalization)
+    return await assign_ticket(db, ticket)
@@ -9,6 +9,7 @@ class BusinessUnitOut(BaseModel):
     address: Optional[str]
     lat: Optional[float]
     lon: Optional[float]
+    active: bool = True
 
     class Config:
         from_attributes = True
@@ -21,6 +22,7 @@ class ManagerOut(BaseModel):
     office_name: Optional[str]
     skills: Optional[str]
     workload: int
+    active: bool = True
 
     class Config:
         from_attributes = True
@@ -59,10 +61,41 @@ class TicketDetail(TicketOut):
         from_attributes = True
 
 
+class DeadLetterOut(BaseModel):
+    id: int
+    ticket_id: int
+    attempts: int
+    last_error: Optional[str]
+    failed_at: Optional[datetime]
+
+    class Config:
+        from_attributes = True
+
+
 class ProcessResponse(BaseModel):
     processed: int
     failed: int
     message: str
+    skipped: int = 0
+    deferred: int = 0                       # sharded mode: assignment left to the office owner
+    stopped_reason: Optional[str] = None   # max_seconds | max_tokens | max_calls
+    elapsed_sec: Optional[float] = None
+    llm_usage: Optional[dict] = None
+
+
+class Reassignment(BaseModel):
+    ticket_id: int
+    old_office: Optional[str]
+    new_office: Optional[str]
+    old_manager_id: Optional[int]
+    new_manager_id: Optional[int]
+
+
+class RebalanceResponse(BaseModel):
+    examined: int
+    reassigned: int
+    unassigned: int
+    changes: List[Reassignment]
 
 
 class StatsResponse(BaseModel):
@@ -87,4 +120,6 @@ class UploadResponse(BaseModel):
     filename: str
     rows_total: int
     rows_imported: int
-    message: str
\ No newline at end of file
+    message: str
+    rows_updated: int = 0
+    rows_deactivated: int = 0
\ No newline at end of file
@@ -6,11 +6,16 @@ import io
 import math
 import os
 import asyncio
-import pandas as pd
+from typing import Any, Dict, TYPE_CHECKING
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from app.models import BusinessUnit, Manager, Ticket
 from app.geo import geocode_best, simplify_address
+from app.routing import bump_roster_version
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 
@@ -37,13 +42,17 @@ def clean_house(v) -> str:
     return s
 
 
-def read_csv_bytes(data: bytes) -> pd.DataFrame:
+def read_csv_bytes(data: bytes) -> "pd.DataFrame":
+    import pandas as pd  # deferred: pandas dominates cold start
+
     df = pd.read_csv(io.BytesIO(data))
     df.columns = [c.strip() for c in df.columns]
     return df
 
 
-def read_csv_path(path: str) -> pd.DataFrame:
+def read_csv_path(path: str) -> "pd.DataFrame":
+    import pandas as pd
+
     df = pd.read_csv(path)
     df.columns = [c.strip() for c in df.columns]
     return df
@@ -51,7 +60,7 @@ def read_csv_path(path: str) -> pd.DataFrame:
 
 # ─── Business Units ───────────────────────────────────────────────────────────
 
-async def load_business_units(db: AsyncSession, df: pd.DataFrame, replace: bool = False):
+async def load_business_units(db: AsyncSession, df: "pd.DataFrame", replace: bool = False):
     if replace:
         await db.execute(delete(BusinessUnit))
         await db.commit()
@@ -83,6 +92,72 @@ async def load_business_units(db: AsyncSession, df: pd.DataFrame, replace: bool
     return added
 
 
+async def _geocode_office(name: str, addr: str):
+    loop = asyncio.get_event_loop()
+    full      = f"{name}, {addr}, Казахстан"
+    simp      = f"{name}, {simplify_address(addr)}, Казахстан"
+    city_only = f"{name}, Казахстан"
+    return await loop.run_in_executor(
+        None, lambda: geocode_best([full, simp, city_only], sleep_sec=0.5)
+    )
+
+
+async def sync_business_units(db: AsyncSession, df: "pd.DataFrame") -> Dict[str, Any]:
+    """
+    Diff the CSV against the table in one pass and apply it as one bulk upsert.
+    Only new or re-addressed offices are geocoded; offices missing from the
+    CSV are soft-deleted (active=false) so ticket/manager references stay valid.
+    """
+    incoming: Dict[str, str] = {}
+    for _, row in df.iterrows():
+        name = clean_text(row.get("Офис"))
+        if name:
+            incoming[name] = clean_text(row.get("Адрес"))
+
+    existing = {
+        r.name: r for r in (await db.execute(
+            select(BusinessUnit.name, BusinessUnit.address, BusinessUnit.lat,
+                   BusinessUnit.lon, BusinessUnit.active)
+        )).all()
+    }
+
+    rows, inserted, updated = [], 0, 0
+    for name, addr in incoming.items():
+        old = existing.get(name)
+        if old is not None and old.address == addr and old.active:
+            continue
+        if old is not None and old.address == addr:
+            lat, lon = old.lat, old.lon
+        else:
+            lat, lon = await _geocode_office(name, addr)
+        rows.append({"name": name, "address": addr, "lat": lat, "lon": lon, "active": True})
+        if old is None:
+            inserted += 1
+        else:
+            updated += 1
+
+    if rows:
+        stmt = pg_insert(BusinessUnit).values(rows)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[BusinessUnit.name],
+            set_={c: stmt.excluded[c] for c in ("address", "lat", "lon", "active")},
+        ))
+
+    removed = [n for n, r in existing.items() if r.active and n not in incoming]
+    if removed:
+        await db.execute(
+            update(BusinessUnit).where(BusinessUnit.name.in_(removed)).values(active=False)
+        )
+    await db.commit()
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "deactivated": len(removed),
+        "touched_offices": {r["name"] for r in rows} | set(removed),
+    }
+
+
 async def seed_business_units(db: AsyncSession):
     path = os.path.join(DATA_DIR, "business_units.csv")
     if not os.path.exists(path):
@@ -94,8 +169,11 @@ async def seed_business_units(db: AsyncSession):
 
 # ─── Managers ─────────────────────────────────────────────────────────────────
 
-async def load_managers(db: AsyncSession, df: pd.DataFrame, replace: bool = False):
+async def load_managers(db: AsyncSession, df: "pd.DataFrame", replace: bool = False):
     if replace:
+        # Detach tickets first; they are re-routed by app.rebalance afterwards
+        await bump_roster_version(db)
+        await db.execute(update(Ticket).values(manager_id=None))
         await db.execute(delete(Manager))
         await db.commit()
 
@@ -126,10 +204,87 @@ async def load_managers(db: AsyncSession, df: pd.DataFrame, replace: bool = Fals
         ))
         added += 1
 
+    if added:
+        await bump_roster_version(db)
     await db.commit()
     return added
 
 
+async def sync_managers(db: AsyncSession, df: "pd.DataFrame") -> Dict[str, Any]:
+    """
+    Diff the CSV against the table in one pass and apply inserts/updates as a
+    single INSERT ... ON CONFLICT (full_name) DO UPDATE. Live workload and
+    round_robin_index are never overwritten for existing managers (the CSV
+    workload only seeds new ones); managers missing from the CSV are
+    soft-deleted. Returns counts plus the set of offices whose roster changed.
+    """
+    incoming: Dict[str, Dict[str, Any]] = {}
+    for _, row in df.iterrows():
+        name = clean_text(row.get("ФИО"))
+        if not name:
+            continue
+        try:
+            workload = int(row.get("Количество обращений в работе", 0))
+        except Exception:
+            workload = 0
+        incoming[name] = {
+            "full_name": name,
+            "position": clean_text(row.get("Должность")),
+            "office_name": clean_text(row.get("Офис")),
+            "skills": clean_text(row.get("Навыки")),
+            "workload": workload,
+            "round_robin_index": 0,
+            "active": True,
+        }
+
+    existing = {
+        r.full_name: r for r in (await db.execute(
+            select(Manager.full_name, Manager.position, Manager.office_name,
+                   Manager.skills, Manager.active)
+        )).all()
+    }
+
+    rows, touched = [], set()
+    inserted = updated = 0
+    for name, new in incoming.items():
+        old = existing.get(name)
+        if old is None:
+            inserted += 1
+        elif (old.position, old.office_name, old.skills, old.active) == (
+            new["position"], new["office_name"], new["skills"], True
+        ):
+            continue
+        else:
+            updated += 1
+            touched.add(old.office_name)
+        rows.append(new)
+        touched.add(new["office_name"])
+
+    # Before any manager write: shard batches lock the roster row first too
+    await bump_roster_version(db)
+    if rows:
+        stmt = pg_insert(Manager).values(rows)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[Manager.full_name],
+            set_={c: stmt.excluded[c] for c in ("position", "office_name", "skills", "active")},
+        ))
+
+    removed = [n for n, r in existing.items() if r.active and n not in incoming]
+    if removed:
+        await db.execute(
+            update(Manager).where(Manager.full_name.in_(removed)).values(active=False)
+        )
+        touched |= {existing[n].office_name for n in removed}
+    await db.commit()
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "deactivated": len(removed),
+        "touched_offices": {o for o in touched if o},
+    }
+
+
 async def seed_managers(db: AsyncSession):
     path = os.path.join(DATA_DIR, "managers.csv")
     if not os.path.exists(path):
@@ -141,7 +296,7 @@ async def seed_managers(db: AsyncSession):
 
 # ─── Tickets ──────────────────────────────────────────────────────────────────
 
-async def load_tickets(db: AsyncSession, df: pd.DataFrame, replace: bool = False):
+async def load_tickets(db: AsyncSession, df: "pd.DataFrame", replace: bool = False):
     if replace:
         await db.execute(delete(Ticket))
         await db.commit()
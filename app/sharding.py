@@ -0,0 +1,282 @@
+"""
+Office-sharded assignment across worker nodes (SHARDING_ENABLED=1).
+
+Each node heartbeats into worker_nodes; live nodes form a consistent-hash
+ring over office names, and each node takes a lease (office_leases) on
+the offices that hash to it. Enrichment workers on any node choose the
+office and leave the ticket enriched-but-unassigned; the owning node
+assigns from an in-memory, authoritative copy of that office's managers
+and persists tickets + workloads in one batch per tick. Every batch
+renews the lease in the same transaction, so a node that lost ownership
+cannot commit stale assignments. Manager writes from any node (uploads,
+rebalancing) bump roster_version; each batch share-locks that row and
+reloads its rosters when the version moved, so it never writes back
+workloads from before such a change.
+"""
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.database import AsyncSessionLocal
+from app.events import broadcaster
+from app.httpcache import data_versions
+from app.models import Ticket, Manager, BusinessUnit, WorkerNode, OfficeLease, RosterVersion
+from app.routing import pick_manager
+from app.scheduler import service_class, time_to_assignment
+
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "0") == "1"
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+HEARTBEAT_SEC = float(os.getenv("SHARD_HEARTBEAT_SEC", "5"))
+NODE_TTL_SEC = HEARTBEAT_SEC * 3
+LEASE_TTL_SEC = HEARTBEAT_SEC * 3
+ASSIGN_INTERVAL_SEC = float(os.getenv("SHARD_ASSIGN_INTERVAL_SEC", "0.5"))
+ASSIGN_BATCH = int(os.getenv("SHARD_ASSIGN_BATCH", "500"))
+VNODES = 64
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing with virtual nodes: a join/leave moves ~1/N of offices."""
+
+    def __init__(self, nodes: List[str], vnodes: int = VNODES):
+        points = sorted((_hash(f"{n}#{i}"), n) for n in nodes for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+class ShardCoordinator:
+    def __init__(self, node_id: str = NODE_ID):
+        self.node_id = node_id
+        self.owned: Set[str] = set()
+        self._managers: Dict[str, List[Manager]] = {}   # authoritative while owned
+        self._tasks: List[asyncio.Task] = []
+        # Roster version the in-memory managers match; None forces a reload
+        # (newly gained offices, or memory ahead of the DB after a failed batch)
+        self._roster_version: Optional[int] = None
+        self.assigned_total = 0
+
+    # ── membership + leases ──────────────────────────────────────────────────
+
+    def _assigning(self) -> bool:
+        return len(self._tasks) > 1 and not self._tasks[1].done()
+
+    async def _heartbeat(self):
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                stmt = pg_insert(WorkerNode).values(node_id=self.node_id, last_seen=now)
+                await db.execute(stmt.on_conflict_do_update(
+                    index_elements=[WorkerNode.node_id], set_={"last_seen": now},
+                ))
+                await db.execute(delete(WorkerNode).where(
+                    WorkerNode.last_seen < now - timedelta(seconds=NODE_TTL_SEC * 4)
+                ))
+                nodes = (await db.execute(select(WorkerNode.node_id).where(
+                    WorkerNode.last_seen >= now - timedelta(seconds=NODE_TTL_SEC)
+                ))).scalars().all()
+                offices = (await db.execute(
+                    select(BusinessUnit.name).where(BusinessUnit.active.is_(True))
+                )).scalars().all()
+
+                ring = HashRing(sorted(nodes))
+                wanted = {o for o in offices if ring.owner(o) == self.node_id}
+                if not self._assigning():
+                    # Never hold leases for offices this node cannot serve
+                    wanted = set()
+
+                # Give up offices that moved to another node
+                lost = self.owned - wanted
+                if lost:
+                    await db.execute(delete(OfficeLease).where(
+                        OfficeLease.office_name.in_(lost),
+                        OfficeLease.node_id == self.node_id,
+                    ))
+
+                # Take (or renew) leases that are free, expired, or already ours
+                expires = now + timedelta(seconds=LEASE_TTL_SEC)
+                acquired: Set[str] = set()
+                for office in wanted:
+                    stmt = pg_insert(OfficeLease).values(
+                        office_name=office, node_id=self.node_id, expires_at=expires,
+                    ).on_conflict_do_update(
+                        index_elements=[OfficeLease.office_name],
+                        set_={"node_id": self.node_id, "expires_at": expires},
+                        where=or_(
+                            OfficeLease.node_id == self.node_id,
+                            OfficeLease.expires_at < now,
+                        ),
+                    ).returning(OfficeLease.office_name)
+                    if (await db.execute(stmt)).scalar_one_or_none():
+                        acquired.add(office)
+
+        for office in self.owned - acquired:
+            self._managers.pop(office, None)
+        gained = acquired - self.owned
+        self.owned = acquired
+        if gained:
+            self._roster_version = None   # next batch loads them under the roster lock
+
+    async def _load_offices(self, offices: Set[str], db):
+        """Snapshot managers for owned offices; from now on memory is authoritative."""
+        rows = (await db.execute(
+            select(Manager)
+            .where(Manager.office_name.in_(offices), Manager.active.is_(True))
+            .order_by(Manager.id)
+        )).scalars().all()
+        for m in rows:
+            db.expunge(m)   # mutated in memory, persisted only by the batch UPDATE
+        self._managers = {}
+        for office in offices:
+            self._managers[office] = []
+        for m in rows:
+            self._managers[m.office_name].append(m)
+
+    # ── assignment ───────────────────────────────────────────────────────────
+
+    async def _assign_batch(self) -> int:
+        if not self.owned:
+            return 0
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                # Fence: renew our leases; drop offices we no longer hold
+                res = await db.execute(
+                    update(OfficeLease)
+                    .where(
+                        OfficeLease.office_name.in_(self.owned),
+                        OfficeLease.node_id == self.node_id,
+                    )
+                    .values(expires_at=datetime.utcnow() + timedelta(seconds=LEASE_TTL_SEC))
+                    .returning(OfficeLease.office_name)
+                )
+                held = set(res.scalars().all())
+                # Share lock: manager writers wait for this batch, and it for them
+                version = (await db.execute(
+                    select(RosterVersion.version).where(RosterVersion.id == 1)
+                    .with_for_update(read=True)
+                )).scalar_one_or_none() or 0
+                if version != self._roster_version:
+                    await self._load_offices(set(self.owned), db)
+                    self._roster_version = version
+                tickets = (await db.execute(
+                    select(Ticket)
+                    .where(
+                        Ticket.enriched_at.isnot(None),
+                        Ticket.processed_at.is_(None),
+                        Ticket.office_name.in_(held),
+                    )
+                    .order_by(Ticket.priority.desc().nullslast(), Ticket.id)
+                    .limit(ASSIGN_BATCH)
+                    .with_for_update(skip_locked=True)
+                )).scalars().all()
+                if not tickets:
+                    return 0
+
+                now = datetime.utcnow()
+                touched: Dict[int, Manager] = {}
+                ticket_rows = []
+                for t in tickets:
+                    chosen = pick_manager(
+                        self._managers.get(t.office_name, []),
+                        t.segment or "Mass", t.ticket_type, t.language,
+                    )
+                    if chosen is not None:
+                        touched[chosen.id] = chosen
+                    ticket_rows.append({
+                        "id": t.id,
+                        "manager_id": chosen.id if chosen else None,
+                        "processed_at": now,
+                    })
+
+                await db.execute(update(Ticket), ticket_rows)
+                if touched:
+                    await db.execute(update(Manager), [
+                        {"id": m.id, "workload": m.workload, "round_robin_index": m.round_robin_index}
+                        for m in touched.values()
+                    ])
+        data_versions.bump("tickets", "managers")
+        # Same events and metrics as the single-node path in process_all_tickets
+        for t, row in zip(tickets, ticket_rows):
+            broadcaster.publish({
+                "type": "ticket",
+                "id": t.id,
+                "ticket_type": t.ticket_type,
+                "priority": t.priority,
+                "language": t.language,
+                "office": t.office_name,
+                "manager_id": row["manager_id"],
+            })
+            if t.created_at is not None:
+                time_to_assignment.record(
+                    service_class(t), (now - t.created_at).total_seconds()
+                )
+        self.assigned_total += len(tickets)
+        return len(tickets)
+
+    # ── lifecycle ────────────────────────────────────────────────────────────
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await self._heartbeat()
+            except Exception as e:
+                print(f"Shard heartbeat failed on {self.node_id}: {e}")
+            await asyncio.sleep(HEARTBEAT_SEC)
+
+    async def _assign_loop(self):
+        while True:
+            try:
+                n = await self._assign_batch()
+            except Exception as e:
+                print(f"Shard assignment failed on {self.node_id}: {e}")
+                # Memory may be ahead of the rolled-back DB state; the next
+                # batch reloads first, and keeps retrying while the DB is down
+                self._roster_version = None
+                n = 0
+            if n < ASSIGN_BATCH:
+                await asyncio.sleep(ASSIGN_INTERVAL_SEC)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._heartbeat_loop()),
+                asyncio.create_task(self._assign_loop()),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        # Hand offices back immediately instead of waiting for lease expiry
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                await db.execute(delete(OfficeLease).where(OfficeLease.node_id == self.node_id))
+                await db.execute(delete(WorkerNode).where(WorkerNode.node_id == self.node_id))
+        self.owned = set()
+        self._managers = {}
+
+    def status(self) -> Dict:
+        return {
+            "enabled": SHARDING_ENABLED,
+            "node_id": self.node_id,
+            "owned_offices": sorted(self.owned),
+            "assigned_total": self.assigned_total,
+        }
+
+
+coordinator = ShardCoordinator()
@@ -0,0 +1,270 @@
+"""
+In-memory dry-run of the routing cascade for capacity planning.
+
+Replays enriched tickets against a scenario (managers / offices from CSV
+or the live DB) with the same rules as process_ticket_assignment:
+nearest office (find_nearest_office_cached), the Астана/Алматы 50/50
+fallback, manager_can_handle eligibility, and least-workload +
+round-robin selection. No DB writes, LLM or geocoding calls.
+
+Office lookup is a vectorised haversine over all tickets at once. Manager
+selection is inherently sequential, but since every assignment adds 1 to
+both workload and round_robin_index, the (workload, rr) sort key is packed
+into one int and the argmin runs over a precomputed eligible list per
+(office, eligibility class) — about a microsecond per ticket.
+"""
+from types import SimpleNamespace
+from typing import Any, Dict, List, TYPE_CHECKING
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.geo import is_kazakhstan
+from app.models import Ticket, Manager, BusinessUnit
+from app.routing import manager_can_handle
+from app.seeder import clean_text
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+FALLBACK_OFFICES = ("Астана", "Алматы")
+TICKET_COLUMNS = ["client_guid", "segment", "country", "city", "ticket_type",
+                  "language", "client_lat", "client_lon"]
+_RR_SHIFT = 32
+
+
+# ── Inputs ────────────────────────────────────────────────────────────────────
+
+async def load_db_tickets(db: AsyncSession, since=None, until=None) -> "pd.DataFrame":
+    import pandas as pd
+
+    q = select(*[getattr(Ticket, c) for c in TICKET_COLUMNS]).where(Ticket.enriched_at.isnot(None))
+    if since is not None:
+        q = q.where(Ticket.created_at >= since)
+    if until is not None:
+        q = q.where(Ticket.created_at < until)
+    q = q.order_by(Ticket.priority.desc().nullslast(), Ticket.id)
+    rows = (await db.execute(q)).all()
+    return pd.DataFrame(rows, columns=TICKET_COLUMNS)
+
+
+async def tickets_from_csv(db: AsyncSession, df: "pd.DataFrame") -> "pd.DataFrame":
+    """tickets.csv joined with stored enrichment by GUID; CSV enrichment columns win if present."""
+    import pandas as pd
+
+    guids = [clean_text(g) for g in df["GUID клиента"]]
+    stored = await db.execute(
+        select(*[getattr(Ticket, c) for c in TICKET_COLUMNS]).where(Ticket.client_guid.in_(guids))
+    )
+    base = pd.DataFrame(stored.all(), columns=TICKET_COLUMNS).set_index("client_guid")
+    out = pd.DataFrame({"client_guid": guids})
+    out = out.join(base, on="client_guid")
+    csv_map = {
+        "Сегмент клиента": "segment", "Страна": "country", "Населённый пункт": "city",
+        "ticket_type": "ticket_type", "language": "language",
+        "client_lat": "client_lat", "client_lon": "client_lon",
+    }
+    for src, dst in csv_map.items():
+        if src in df.columns:
+            vals = df[src].reset_index(drop=True)
+            out[dst] = vals.where(vals.notna(), out[dst])
+    return out
+
+
+async def load_db_managers(db: AsyncSession) -> "pd.DataFrame":
+    import pandas as pd
+
+    rows = (await db.execute(
+        select(Manager.id, Manager.full_name, Manager.position, Manager.office_name,
+               Manager.skills, Manager.workload, Manager.round_robin_index)
+        .where(Manager.active.is_(True))
+        .order_by(Manager.id)
+    )).all()
+    return pd.DataFrame(rows, columns=["id", "full_name", "position", "office_name",
+                                       "skills", "workload", "round_robin_index"])
+
+
+def managers_from_csv(df: "pd.DataFrame") -> "pd.DataFrame":
+    import pandas as pd
+
+    out = pd.DataFrame({
+        "id": range(1, len(df) + 1),
+        "full_name": [clean_text(v) for v in df["ФИО"]],
+        "position": [clean_text(v) for v in df.get("Должность", [""] * len(df))],
+        "office_name": [clean_text(v) for v in df["Офис"]],
+        "skills": [clean_text(v) for v in df.get("Навыки", [""] * len(df))],
+    })
+    wl = df.get("Количество обращений в работе")
+    out["workload"] = pd.to_numeric(wl, errors="coerce").fillna(0).astype(int).values if wl is not None else 0
+    out["round_robin_index"] = 0
+    return out[out["full_name"] != ""]
+
+
+async def load_db_offices(db: AsyncSession) -> "pd.DataFrame":
+    import pandas as pd
+
+    rows = (await db.execute(
+        select(BusinessUnit.name, BusinessUnit.lat, BusinessUnit.lon)
+        .where(BusinessUnit.active.is_(True))
+    )).all()
+    return pd.DataFrame(rows, columns=["name", "lat", "lon"])
+
+
+def offices_from_csv(df: "pd.DataFrame", known: "pd.DataFrame") -> "pd.DataFrame":
+    """Office names from CSV; coordinates from lat/lon columns or the known offices."""
+    import pandas as pd
+
+    names = [clean_text(v) for v in df["Офис"]]
+    out = pd.DataFrame({"name": names}).merge(known, on="name", how="left")
+    for col in ("lat", "lon"):
+        if col in df.columns:
+            vals = pd.to_numeric(df[col], errors="coerce").reset_index(drop=True)
+            out[col] = vals.where(vals.notna(), out[col])
+    return out[out["name"] != ""]
+
+
+# ── Simulation ────────────────────────────────────────────────────────────────
+
+def _nearest_offices(lat, lon, offices: "pd.DataFrame", chunk: int = 200_000):
+    import numpy as np
+
+    olat = np.radians(offices["lat"].to_numpy(dtype=float))
+    olon = np.radians(offices["lon"].to_numpy(dtype=float))
+    names = offices["name"].to_numpy()
+    out = np.empty(len(lat), dtype=object)
+    for s in range(0, len(lat), chunk):
+        la = np.radians(lat[s:s + chunk])[:, None]
+        lo = np.radians(lon[s:s + chunk])[:, None]
+        a = np.sin((olat - la) / 2) ** 2 + np.cos(la) * np.cos(olat) * np.sin((olon - lo) / 2) ** 2
+        out[s:s + chunk] = names[np.argmin(a, axis=1)]   # argmin of a == argmin of distance
+    return out
+
+
+def simulate(
+    tickets: "pd.DataFrame",
+    managers: "pd.DataFrame",
+    offices: "pd.DataFrame",
+    initial_workload: str = "zero",
+) -> Dict[str, Any]:
+    import numpy as np
+    import pandas as pd
+
+    n = len(tickets)
+    offices = offices.dropna(subset=["lat", "lon"])
+    lat = pd.to_numeric(tickets["client_lat"], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(tickets["client_lon"], errors="coerce").to_numpy(dtype=float)
+
+    # ── Geography: same branch conditions as choose_office ───────────────────
+    kz_by_country = {c: is_kazakhstan(c or "") for c in tickets["country"].fillna("").unique()}
+    in_kz = tickets["country"].fillna("").map(kz_by_country).to_numpy(dtype=bool)
+    has_city = tickets["city"].fillna("").astype(str).str.strip().to_numpy() != ""
+    located = in_kz & has_city & ~np.isnan(lat) & ~np.isnan(lon) & (len(offices) > 0)
+
+    office = np.empty(n, dtype=object)
+    if located.any():
+        office[located] = _nearest_offices(lat[located], lon[located], offices)
+    fb = ~located
+    # Toggle alternates in processing order, starting with Астана
+    office[fb] = np.where(np.arange(fb.sum()) % 2 == 0, *FALLBACK_OFFICES)
+
+    # ── Competency + workload ────────────────────────────────────────────────
+    mgr = managers.reset_index(drop=True)
+    w0 = mgr["workload"].fillna(0).astype(int) if initial_workload == "current" else pd.Series(0, index=mgr.index)
+    r0 = mgr["round_robin_index"].fillna(0).astype(int) if initial_workload == "current" else pd.Series(0, index=mgr.index)
+    score = [(int(w) << _RR_SHIFT) + int(r) for w, r in zip(w0, r0)]
+    step = (1 << _RR_SHIFT) + 1
+    proxies = [
+        SimpleNamespace(skills=s or "", position=p or "")
+        for s, p in zip(mgr["skills"], mgr["position"])
+    ]
+    by_office: Dict[str, List[int]] = {}
+    for i, o in enumerate(mgr["office_name"]):
+        by_office.setdefault(o, []).append(i)
+
+    segment = tickets["segment"].fillna("").replace("", "Mass").to_numpy()
+    ttype = tickets["ticket_type"].fillna("").to_numpy()
+    lang = tickets["language"].fillna("").to_numpy()
+
+    eligible_cache: Dict[tuple, List[int]] = {}
+    assigned = np.full(n, -1, dtype=np.int64)
+    for k in range(n):
+        # Eligibility depends only on these attributes, so a handful of classes cover all tickets
+        key = (office[k], segment[k] in ("VIP", "Priority"), ttype[k] == "Смена данных", lang[k])
+        cands = eligible_cache.get(key)
+        if cands is None:
+            cands = [
+                i for i in by_office.get(office[k], [])
+                if manager_can_handle(proxies[i], segment[k], ttype[k], lang[k])
+            ]
+            eligible_cache[key] = cands
+        if not cands:
+            continue
+        best = min(cands, key=score.__getitem__)
+        score[best] += step
+        assigned[k] = best
+
+    # ── Report ───────────────────────────────────────────────────────────────
+    counts = np.bincount(assigned[assigned >= 0], minlength=len(mgr))
+    final = w0.to_numpy() + counts
+    per_manager = [
+        {
+            "manager": mgr.at[i, "full_name"],
+            "office": mgr.at[i, "office_name"],
+            "assigned": int(counts[i]),
+            "final_workload": int(final[i]),
+        }
+        for i in range(len(mgr))
+    ]
+    per_office = pd.Series(office).value_counts().to_dict()
+    return {
+        "tickets": n,
+        "unassigned": int((assigned < 0).sum()),
+        "fallback_rate": float(fb.mean()) if n else 0.0,
+        "load": _distribution(final) if len(mgr) else {},
+        "per_office": {str(k): int(v) for k, v in per_office.items()},
+        "per_manager": per_manager,
+    }
+
+
+def _distribution(values) -> Dict[str, float]:
+    import numpy as np
+
+    v = np.sort(np.asarray(values, dtype=float))
+    total = v.sum()
+    # Gini: 0 = perfectly even load, → 1 = all on one manager
+    gini = float((2 * np.arange(1, len(v) + 1) - len(v) - 1) @ v / (len(v) * total)) if total else 0.0
+    return {
+        "min": float(v[0]), "p50": float(np.median(v)), "p95": float(np.percentile(v, 95)),
+        "max": float(v[-1]), "mean": float(v.mean()), "std": float(v.std()), "gini": gini,
+    }
+
+
+def diff_reports(baseline: Dict[str, Any], scenario: Dict[str, Any]) -> Dict[str, Any]:
+    base_m = {m["manager"]: m for m in baseline["per_manager"]}
+    scen_m = {m["manager"]: m for m in scenario["per_manager"]}
+    managers = []
+    for name in sorted(set(base_m) | set(scen_m)):
+        b, s = base_m.get(name), scen_m.get(name)
+        delta = (s["assigned"] if s else 0) - (b["assigned"] if b else 0)
+        if delta or b is None or s is None:
+            managers.append({
+                "manager": name,
+                "baseline": b["assigned"] if b else None,
+                "scenario": s["assigned"] if s else None,
+                "delta": delta,
+            })
+    offices = sorted(set(baseline["per_office"]) | set(scenario["per_office"]))
+    return {
+        "unassigned_delta": scenario["unassigned"] - baseline["unassigned"],
+        "fallback_rate_delta": scenario["fallback_rate"] - baseline["fallback_rate"],
+        "load_delta": {
+            k: scenario["load"].get(k, 0) - baseline["load"].get(k, 0)
+            for k in baseline["load"]
+        },
+        "per_office_delta": {
+            o: scenario["per_office"].get(o, 0) - baseline["per_office"].get(o, 0)
+            for o in offices
+            if scenario["per_office"].get(o, 0) != baseline["per_office"].get(o, 0)
+        },
+        "managers": managers,
+    }
@@ -0,0 +1,279 @@
+"""
+Columnar analytics snapshot of processed tickets.
+
+Processed tickets are exported incrementally into Parquet part files
+under SNAPSHOT_DIR and queried in-process with DuckDB, so trend and
+per-manager endpoints never hit Postgres. The change feed is
+Ticket.updated_at, stamped by a trigger on every write (rebalancing
+included). Stamps are taken before commit, so each refresh re-reads an
+overlap window behind the watermark and skips rows it already exported;
+the query layer keeps the latest version of each id. Once there are
+more than SNAPSHOT_MAX_PARTS parts they are compacted into one, and a
+tickets replace triggers a full rebuild so deleted rows disappear.
+"""
+import asyncio
+import glob
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import AsyncSessionLocal, read_sessionmaker
+from app.models import Ticket, Manager
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/tmp/analytics_snapshot")
+SNAPSHOT_INTERVAL_SEC = float(os.getenv("SNAPSHOT_INTERVAL_SEC", "300"))
+# Longer than any transaction that writes tickets
+SNAPSHOT_OVERLAP_SEC = float(os.getenv("SNAPSHOT_OVERLAP_SEC", "120"))
+# Every part costs the query layer a file scan and the dedup window more rows
+SNAPSHOT_MAX_PARTS = int(os.getenv("SNAPSHOT_MAX_PARTS", "24"))
+EXPORT_BATCH = 50_000
+
+COLUMNS = [
+    "id", "ticket_type", "sentiment", "priority", "language", "segment",
+    "city", "office_name", "manager_id", "manager_name", "created_at", "processed_at",
+]
+
+DIMENSIONS = {"ticket_type", "sentiment", "language", "segment", "office_name", "city"}
+BUCKETS = {"hour", "day", "week", "month"}
+METRICS = {
+    "count": "count(*)",
+    "avg_priority": "round(avg(priority), 2)",
+    "negative_share": "round(avg(CASE WHEN sentiment = 'Негативный' THEN 1.0 ELSE 0.0 END), 3)",
+}
+
+_write_lock = threading.Lock()
+_refresh_lock = asyncio.Lock()   # the loop, POST /analytics/snapshot and replace rebuilds
+_state: Dict[str, Any] = {"watermark": None, "rows": 0, "refreshed_at": None}
+# id → updated_at of rows exported inside the current overlap window
+_recent: Dict[int, datetime] = {}
+
+
+def _parts() -> List[str]:
+    return sorted(glob.glob(os.path.join(SNAPSHOT_DIR, "part-*.parquet")))
+
+
+def _write_part(rows: List[Dict[str, Any]], replace: bool):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with _write_lock:
+        existing = _parts()
+        seq = 0 if replace or not existing else int(existing[-1][-16:-8]) + 1
+        path = os.path.join(SNAPSHOT_DIR, f"part-{seq:08d}.parquet")
+        tmp = path + ".tmp"
+        table = pa.Table.from_pylist(rows, schema=pa.schema([
+            ("id", pa.int64()), ("ticket_type", pa.string()), ("sentiment", pa.string()),
+            ("priority", pa.int32()), ("language", pa.string()), ("segment", pa.string()),
+            ("city", pa.string()), ("office_name", pa.string()), ("manager_id", pa.int64()),
+            ("manager_name", pa.string()), ("created_at", pa.timestamp("us")),
+            ("processed_at", pa.timestamp("us")),
+        ]))
+        pq.write_table(table, tmp, compression="zstd")
+        if replace:
+            for old in existing:
+                os.remove(old)
+        os.replace(tmp, path)
+
+
+def _latest_rows(parts: List[str]) -> str:
+    """SQL source with one row per id, the version from the newest part."""
+    # Part paths are generated here, never user input
+    files = ", ".join("'" + p.replace("'", "''") + "'" for p in parts)
+    if len(parts) == 1:
+        return f"read_parquet([{files}])"   # compacted or rebuilt: already one row per id
+    return (
+        f"(SELECT * EXCLUDE (filename) FROM read_parquet([{files}], filename = true) "
+        "QUALIFY row_number() OVER (PARTITION BY id ORDER BY filename DESC) = 1)"
+    )
+
+
+def _compact():
+    """Merge all parts into one, written over the newest so later appends still sort after it."""
+    import duckdb
+
+    with _write_lock:
+        parts = _parts()
+        if len(parts) < 2:
+            return
+        path = parts[-1]
+        tmp = path + ".tmp"
+        con = duckdb.connect()
+        try:
+            con.execute(
+                f"COPY (SELECT * FROM {_latest_rows(parts)} ORDER BY id) "
+                "TO '" + tmp.replace("'", "''") + "' (FORMAT parquet, COMPRESSION zstd)"
+            )
+        finally:
+            con.close()
+        os.replace(tmp, path)
+        for old in parts[:-1]:
+            os.remove(old)
+
+
+async def refresh_snapshot(db: AsyncSession, full: bool = False) -> Dict[str, Any]:
+    """Append tickets changed since the last watermark (or rebuild everything)."""
+    async with _refresh_lock:
+        return await _refresh(db, full)
+
+
+async def _refresh(db: AsyncSession, full: bool) -> Dict[str, Any]:
+    global _recent
+    watermark: Optional[datetime] = None if full or not _parts() else _state["watermark"]
+    q = (
+        select(
+            Ticket.id, Ticket.ticket_type, Ticket.sentiment, Ticket.priority,
+            Ticket.language, Ticket.segment, Ticket.city, Ticket.office_name,
+            Ticket.manager_id, Manager.full_name.label("manager_name"),
+            Ticket.created_at, Ticket.processed_at, Ticket.updated_at,
+        )
+        .outerjoin(Manager, Manager.id == Ticket.manager_id)
+        .where(Ticket.processed_at.isnot(None))
+        .order_by(Ticket.updated_at.nullsfirst(), Ticket.id)
+        .execution_options(yield_per=EXPORT_BATCH)
+    )
+    if watermark is not None:
+        q = q.where(Ticket.updated_at >= watermark - timedelta(seconds=SNAPSHOT_OVERLAP_SEC))
+    else:
+        _recent = {}
+
+    loop = asyncio.get_event_loop()
+    exported = 0
+    first = True
+    new_watermark = watermark
+    # Server-side cursor: one EXPORT_BATCH of rows in memory at a time
+    result = await db.stream(q)
+    async for part in result.mappings().partitions():
+        rows = []
+        for r in part:
+            row = dict(r)
+            stamp = row.pop("updated_at")
+            if stamp is not None:
+                if _recent.get(row["id"]) == stamp:
+                    continue   # already exported in an earlier overlap window
+                _recent[row["id"]] = stamp
+                if new_watermark is None or stamp > new_watermark:
+                    new_watermark = stamp
+            rows.append(row)
+        if rows:
+            await loop.run_in_executor(None, _write_part, rows, full and first)
+            first = False
+            exported += len(rows)
+    if full and first:
+        await loop.run_in_executor(None, _write_part, [], True)
+    elif len(_parts()) > SNAPSHOT_MAX_PARTS:
+        await loop.run_in_executor(None, _compact)
+
+    if new_watermark is not None:
+        horizon = new_watermark - timedelta(seconds=SNAPSHOT_OVERLAP_SEC)
+        _recent = {k: v for k, v in _recent.items() if v >= horizon}
+    _state["watermark"] = new_watermark
+    _state["rows"] = (_state["rows"] if not full else 0) + exported
+    _state["refreshed_at"] = datetime.utcnow()
+    return {"exported": exported, "full": full, **snapshot_status()}
+
+
+def snapshot_status() -> Dict[str, Any]:
+    return {
+        "parts": len(_parts()),
+        "watermark": _state["watermark"],
+        "refreshed_at": _state["refreshed_at"],
+    }
+
+
+async def snapshot_loop(interval: float = SNAPSHOT_INTERVAL_SEC):
+    """Background task: full rebuild on start, then incremental appends (read replica if healthy)."""
+    full = True
+    while True:
+        try:
+            async with (await read_sessionmaker())() as db:
+                await refresh_snapshot(db, full=full)
+            full = False
+        except Exception as e:
+            print(f"Analytics snapshot refresh failed: {e}")
+        await asyncio.sleep(interval)
+
+
+_rebuild_task: Optional[asyncio.Task] = None
+
+
+async def _rebuild_from_primary():
+    try:
+        async with AsyncSessionLocal() as db:
+            await refresh_snapshot(db, full=True)
+    except Exception as e:
+        print(f"Analytics snapshot rebuild failed: {e}")
+
+
+def schedule_full_rebuild():
+    """After a tickets replace: rebuild from the primary (a replica may still have the old rows)."""
+    global _rebuild_task
+    _rebuild_task = asyncio.create_task(_rebuild_from_primary())
+
+
+# ── Queries (DuckDB, in-process) ──────────────────────────────────────────────
+
+def _query(sql: str, params: List[Any]) -> Dict[str, Any]:
+    import duckdb
+
+    parts = _parts()
+    if not parts:
+        return {"columns": [], "rows": []}
+    source = _latest_rows(parts)
+    con = duckdb.connect()
+    try:
+        cur = con.execute(sql.format(src=source), dict(params))
+        cols = [d[0] for d in cur.description]
+        return {"columns": cols, "rows": [list(r) for r in cur.fetchall()]}
+    finally:
+        con.close()
+
+
+def _range_clause(date_from: Optional[datetime], date_to: Optional[datetime], params: list) -> str:
+    clauses = []
+    if date_from:
+        clauses.append("processed_at >= $date_from")
+        params.append(("date_from", date_from))
+    if date_to:
+        clauses.append("processed_at <= $date_to")
+        params.append(("date_to", date_to))
+    return ("WHERE " + " AND ".join(clauses)) if clauses else ""
+
+
+def timeseries(
+    metric: str, bucket: str, by: Optional[str],
+    date_from: Optional[datetime], date_to: Optional[datetime],
+) -> Dict[str, Any]:
+    """`metric` per time `bucket`, optionally split by one dimension. Names are whitelisted."""
+    params: list = []
+    where = _range_clause(date_from, date_to, params)
+    split = f", {by}" if by else ""
+    sql = (
+        f"SELECT date_trunc('{bucket}', processed_at) AS bucket{split}, {METRICS[metric]} AS {metric} "
+        f"FROM {{src}} {where} GROUP BY ALL ORDER BY bucket{split}"
+    )
+    return _query(sql, params)
+
+
+def manager_breakdown(
+    bucket: Optional[str], office: Optional[str],
+    date_from: Optional[datetime], date_to: Optional[datetime],
+) -> Dict[str, Any]:
+    """Per-manager throughput, mean priority and negative share, optionally per time bucket."""
+    params: list = []
+    where = _range_clause(date_from, date_to, params)
+    if office:
+        where = (where + " AND " if where else "WHERE ") + "office_name = $office"
+        params.append(("office", office))
+    where = (where + " AND " if where else "WHERE ") + "manager_id IS NOT NULL"
+    tb = f"date_trunc('{bucket}', processed_at) AS bucket, " if bucket else ""
+    sql = (
+        f"SELECT {tb}manager_id, manager_name, office_name, count(*) AS tickets, "
+        f"{METRICS['avg_priority']} AS avg_priority, {METRICS['negative_share']} AS negative_share "
+        f"FROM {{src}} {where} GROUP BY ALL ORDER BY {'bucket, ' if bucket else ''}tickets DESC"
+    )
+    return _query(sql, params)
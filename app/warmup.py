@@ -0,0 +1,119 @@
+"""
+Startup warm-up: pool connections, prepared statements, outbound
+keep-alive connections and in-process caches.
+
+asyncpg prepares and caches statements per connection, so each hot query
+is run once on every pre-opened connection (inside a transaction that is
+rolled back). /health reports "warming" until this has finished, so a
+load balancer only sends traffic once first-request latency matches
+steady state.
+"""
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", "10"))
+WARMUP_HTTP = os.getenv("WARMUP_HTTP", "1") == "1"
+WARMUP_TIMEOUT_SEC = float(os.getenv("WARMUP_TIMEOUT_SEC", "60"))
+
+HotQuery = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WarmupState:
+    def __init__(self):
+        self.ready = not WARMUP_ENABLED
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.steps: Dict[str, Any] = {}
+
+    def report(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.monotonic()) - self.started_at, 3)
+        return {"ready": self.ready, "elapsed_sec": elapsed, "steps": self.steps}
+
+
+state = WarmupState()
+
+
+async def warm_pool(
+    factory: async_sessionmaker, connections: int, queries: List[HotQuery]
+) -> int:
+    """
+    Check out `connections` connections at the same time — so the pool
+    really opens that many — and run every hot query on each.
+    """
+    checked_out = 0
+    all_open = asyncio.Event()
+
+    async def one():
+        nonlocal checked_out
+        async with factory() as db:
+            try:
+                await db.connection()
+            except Exception:
+                all_open.set()   # don't leave the other sessions waiting
+                raise
+            checked_out += 1
+            if checked_out >= connections:
+                all_open.set()
+            await all_open.wait()
+            for q in queries:
+                await q(db)
+            await db.rollback()
+
+    await asyncio.gather(*(one() for _ in range(connections)))
+    return connections
+
+
+async def _step(name: str, coro) -> None:
+    started = time.monotonic()
+    try:
+        result = await coro
+        state.steps[name] = {"ok": True, "sec": round(time.monotonic() - started, 3)}
+        if result is not None:
+            state.steps[name]["result"] = result
+    except Exception as e:
+        print(f"Warm-up step {name} failed: {e}")
+        state.steps[name] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+
+async def run(
+    pools: Dict[str, tuple],
+    blocking: Dict[str, Callable[[bool], None]],
+    executor=None,
+    background: Optional[Dict[str, Awaitable[Any]]] = None,
+) -> None:
+    """
+    `pools` maps a label to (sessionmaker, connections, hot queries);
+    `blocking` maps a label to a sync callable run in `executor`; it is
+    passed WARMUP_HTTP to decide whether to open outbound connections.
+    `background` maps a label to startup work already running elsewhere
+    (e.g. a task) that readiness should wait for.
+    Failures are recorded per step; readiness is set regardless, since a
+    cold cache is slower but not broken.
+    """
+    if not WARMUP_ENABLED:
+        return
+    state.started_at = time.monotonic()
+    loop = asyncio.get_event_loop()
+    steps = [
+        _step(f"db:{label}", warm_pool(factory, n, queries))
+        for label, (factory, n, queries) in pools.items()
+    ] + [
+        _step(label, loop.run_in_executor(executor, fn, WARMUP_HTTP))
+        for label, fn in blocking.items()
+    ] + [
+        _step(label, aw) for label, aw in (background or {}).items()
+    ]
+    try:
+        await asyncio.wait_for(asyncio.gather(*steps), WARMUP_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        print(f"Warm-up exceeded {WARMUP_TIMEOUT_SEC}s; reporting ready")
+        state.steps["timeout"] = True
+    state.finished_at = time.monotonic()
+    state.ready = True
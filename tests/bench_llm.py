@@ -0,0 +1,60 @@
+"""
+LLM cascade / hedging benchmark on the fake provider:
+
+    python tests/bench_llm.py --tickets 2000 --concurrency 20
+
+Latencies are reported in provider seconds (wall clock divided by --scale).
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.llm import FAST_MODEL, MIN_CONFIDENCE, STRONG_MODEL, cascade_stats, llm_analyze_ticket  # noqa: E402
+from fake_llm import FakeProvider  # noqa: E402
+
+TEXT = "Не могу войти в приложение, пишет ошибку после обновления. " * 8
+
+SCENARIOS = {
+    "fast only": {"models": [FAST_MODEL], "min_confidence": 0.0, "hedge": False},
+    "strong only": {"models": [STRONG_MODEL], "min_confidence": 0.0, "hedge": False},
+    "cascade": {"models": [FAST_MODEL, STRONG_MODEL], "min_confidence": MIN_CONFIDENCE, "hedge": False},
+    "cascade + hedge": {"models": [FAST_MODEL, STRONG_MODEL], "min_confidence": MIN_CONFIDENCE, "hedge": True},
+}
+
+
+def bench(n: int, concurrency: int, scale: float) -> None:
+    client = FakeProvider(scale=scale)
+    print(f"{n} tickets, concurrency {concurrency}, latencies in provider seconds (scale {scale})")
+    print(f"{'scenario':<18}{'p50':>8}{'p99':>8}{'max':>8}{'escal':>7}{'hedges':>8}{'wins':>6}{'$/1k':>9}")
+    for name, cfg in SCENARIOS.items():
+        cascade_stats.reset()
+        durations: List[float] = []
+
+        def one(_):
+            started = time.monotonic()
+            llm_analyze_ticket(TEXT, max_retries=2, client=client, cascade=cfg)
+            durations.append((time.monotonic() - started) / scale)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(n)))
+        durations.sort()
+        snap = cascade_stats.snapshot()
+        print(
+            f"{name:<18}{durations[n // 2]:>8.2f}{durations[min(n - 1, int(n * 0.99))]:>8.2f}"
+            f"{durations[-1]:>8.2f}{snap['escalations']:>7}{snap['hedges']:>8}{snap['hedge_wins']:>6}"
+            f"{snap['cost_usd'] / n * 1000:>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--tickets", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=20)
+    p.add_argument("--scale", type=float, default=0.01, help="wall-clock seconds per provider second")
+    args = p.parse_args()
+    bench(args.tickets, args.concurrency, args.scale)
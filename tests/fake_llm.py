@@ -0,0 +1,62 @@
+"""
+Local stand-in for the OpenAI client, shared by the cascade tests and
+tests/bench_llm.py.
+"""
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import List, Tuple
+
+from app.llm import CATEGORIES, FAST_MODEL
+
+
+class FakeProvider:
+    """
+    Lognormal latency with a heavy tail, occasional schema-invalid output
+    and a confidence distribution per model. `scale` shrinks wall-clock
+    time so benchmarks run quickly. Subclasses override draw() to script
+    exact answers; every requested model is appended to `calls`.
+    """
+
+    PROFILES = {
+        # median latency sec, tail probability, tail multiplier, invalid rate, confidence beta(a, b)
+        "fast": (0.45, 0.03, 8.0, 0.04, (8.0, 1.5)),
+        "strong": (1.4, 0.02, 5.0, 0.005, (20.0, 1.5)),
+    }
+
+    def __init__(self, scale: float = 0.01, seed: int = 0):
+        self.scale = scale
+        self.calls: List[str] = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.responses = SimpleNamespace(create=self._create)
+
+    def draw(self, model: str) -> Tuple[float, bool, float]:
+        """(latency in provider seconds, invalid output, confidence) for one call."""
+        median, tail_p, tail_x, invalid_p, (a, b) = self.PROFILES[
+            "fast" if model == FAST_MODEL else "strong"
+        ]
+        latency = median * self._rng.lognormvariate(0, 0.35)
+        if self._rng.random() < tail_p:
+            latency *= tail_x
+        return latency, self._rng.random() < invalid_p, self._rng.betavariate(a, b)
+
+    def _create(self, model: str, instructions: str, input: str, **_):
+        with self._lock:
+            self.calls.append(model)
+            latency, invalid, confidence = self.draw(model)
+            ticket_type = self._rng.choice(CATEGORIES)
+        time.sleep(latency * self.scale)
+
+        prompt = (len(instructions) + len(input)) // 3
+        out = "{not json" if invalid else json.dumps({
+            "type": ticket_type, "sentiment": "Нейтральный", "priority": 5,
+            "language": "RU", "summary": "Тест.", "confidence": round(confidence, 3),
+        }, ensure_ascii=False)
+        u = SimpleNamespace(
+            input_tokens=prompt, output_tokens=60,
+            input_tokens_details=SimpleNamespace(cached_tokens=min(prompt, len(instructions) // 3)),
+        )
+        return SimpleNamespace(output_text=out, usage=u)
@@ -0,0 +1,74 @@
+"""Canonical geocode keys and the on-disk cache in app.geo."""
+import json
+import threading
+
+import pytest
+
+from app import geo
+
+
+@pytest.mark.parametrize("ru, kz", [
+    ("Алматинская область", "Алматы облысы"),
+    ("Карагандинская обл.", "Қарағанды облысы"),
+    ("Жамбылская область", "Жамбыл облысы"),
+])
+def test_russian_and_kazakh_region_names_share_a_key(ru, kz):
+    assert geo._canon_region(ru) == geo._canon_region(kz) != ""
+
+
+def test_city_aliases_share_a_key():
+    assert geo.canonical_key("Казахстан", "", "г. Алма-Ата") == geo.canonical_key("Kazakhstan", "", "Almaty")
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    path = tmp_path / "geocode_cache.json"
+    monkeypatch.setattr(geo, "CACHE_FILE", str(path))
+    monkeypatch.setattr(geo, "_cache", {})
+    monkeypatch.setattr(geo, "_cache_loaded", False)
+    monkeypatch.setattr(geo, "_cache_dirty", False)
+    monkeypatch.setattr(geo, "_cache_saved_at", float("-inf"))
+    return path
+
+
+def test_concurrent_misses_leave_a_complete_cache_file(cache_file):
+    geo._load_cache()
+
+    def writer(n):
+        for i in range(200):
+            geo._cache_put(f"kz||city{n}-{i}||", 43.0, 76.0)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    geo.flush_cache()
+
+    assert len(json.loads(cache_file.read_text(encoding="utf-8"))) == 8 * 200
+
+
+def test_saves_are_debounced(cache_file, monkeypatch):
+    monkeypatch.setattr(geo, "CACHE_SAVE_INTERVAL_SEC", 3600)
+    geo._load_cache()
+    geo._cache_put("a", 1.0, 2.0)   # first save goes through
+    geo._cache_put("b", 3.0, 4.0)   # within the interval: held back
+    assert set(json.loads(cache_file.read_text(encoding="utf-8"))) == {"a"}
+    geo.flush_cache()
+    assert set(json.loads(cache_file.read_text(encoding="utf-8"))) == {"a", "b"}
+
+
+def test_concurrent_first_lookups_see_the_file(cache_file):
+    cache_file.write_text(json.dumps({"kz||алматы||": {"lat": 43.2, "lon": 76.9}}), encoding="utf-8")
+    seen = []
+
+    def lookup():
+        geo._load_cache()
+        seen.append(geo._cache.get("kz||алматы||"))
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert seen == [{"lat": 43.2, "lon": 76.9}] * 8
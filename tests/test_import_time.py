@@ -0,0 +1,57 @@
+"""
+Import-time budget for the API module.
+
+Runs `python -X importtime -c "import app.main"` in a fresh interpreter and
+parses the per-module report from stderr, so the check does not depend on
+CI caching or on what the test process has already imported.
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+# Loaded on first use; importing any of them at startup is a regression
+LAZY_MODULES = (
+    "pandas", "numpy", "openai", "requests", "pyarrow", "duckdb", "tiktoken", "pyinstrument",
+)
+
+pytestmark = pytest.mark.skipif(
+    importlib.util.find_spec("fastapi") is None or importlib.util.find_spec("sqlalchemy") is None,
+    reason="app dependencies are not installed",
+)
+
+
+@pytest.fixture(scope="module")
+def import_report():
+    """{module: cumulative microseconds} for a cold `import app.main`."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=REPO_ROOT, capture_output=True, text=True, timeout=120,
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    rows = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows[name.strip()] = int(cumulative)
+    return rows
+
+
+def test_app_main_import_within_budget(import_report):
+    assert "app.main" in import_report
+    cumulative_ms = import_report["app.main"] / 1000
+    assert cumulative_ms <= BUDGET_MS, (
+        f"import app.main took {cumulative_ms:.0f} ms (budget {BUDGET_MS:.0f} ms)"
+    )
+
+
+def test_heavy_dependencies_stay_lazy(import_report):
+    eager = [m for m in LAZY_MODULES if m in import_report]
+    assert not eager, f"imported at startup: {', '.join(eager)}"
@@ -0,0 +1,124 @@
+"""
+Cascade escalation, confidence threshold and hedge granting in
+app.llm, driven by the fake provider with scripted answers.
+"""
+import time
+
+import pytest
+
+from app.llm import (
+    FAST_MODEL, HEDGE_MIN_SAMPLES, STRONG_MODEL, LLMBudgetExceeded, cascade_stats,
+    llm_analyze_ticket,
+)
+from fake_llm import FakeProvider
+
+TEXT = "Не могу войти в приложение после обновления."
+CASCADE = {"models": [FAST_MODEL, STRONG_MODEL], "min_confidence": 0.7, "hedge": False}
+
+
+class ScriptedProvider(FakeProvider):
+    """Answers (latency, invalid, confidence) per model from a fixed script, in call order."""
+
+    def __init__(self, script):
+        super().__init__(scale=1.0)
+        self.script = {model: list(answers) for model, answers in script.items()}
+
+    def draw(self, model):
+        return self.script[model].pop(0)
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats():
+    cascade_stats.reset()
+    yield
+    cascade_stats.reset()
+
+
+def analyze(client, cascade=CASCADE, **kwargs):
+    return llm_analyze_ticket(TEXT, max_retries=1, raise_on_failure=True,
+                              client=client, cascade=cascade, **kwargs)
+
+
+def test_confident_fast_answer_is_not_escalated():
+    client = ScriptedProvider({FAST_MODEL: [(0, False, 0.9)]})
+    result = analyze(client)
+    assert client.calls == [FAST_MODEL]
+    assert "confidence" not in result
+    assert cascade_stats.escalations == 0
+
+
+def test_confidence_at_threshold_is_accepted():
+    client = ScriptedProvider({FAST_MODEL: [(0, False, 0.7)]})
+    analyze(client)
+    assert client.calls == [FAST_MODEL]
+
+
+def test_low_confidence_escalates_to_strong_model():
+    client = ScriptedProvider({FAST_MODEL: [(0, False, 0.3)], STRONG_MODEL: [(0, False, 0.95)]})
+    analyze(client)
+    assert client.calls == [FAST_MODEL, STRONG_MODEL]
+    assert cascade_stats.escalations == 1
+
+
+def test_invalid_output_escalates_to_strong_model():
+    client = ScriptedProvider({FAST_MODEL: [(0, True, 0.9)], STRONG_MODEL: [(0, False, 0.95)]})
+    analyze(client)
+    assert client.calls == [FAST_MODEL, STRONG_MODEL]
+    assert cascade_stats.invalid == {FAST_MODEL: 1}
+
+
+def test_low_confidence_answer_is_kept_when_strong_model_is_invalid():
+    client = ScriptedProvider({FAST_MODEL: [(0, False, 0.3)], STRONG_MODEL: [(0, True, 0.0)]})
+    result = analyze(client)
+    assert result["summary"] == "Тест."
+    assert "confidence" not in result
+
+
+def test_refused_escalation_falls_back_to_low_confidence_answer():
+    client = ScriptedProvider({FAST_MODEL: [(0, False, 0.3)]})
+    grants = iter([True])
+    result = analyze(client, call_gate=lambda: next(grants, False))
+    assert client.calls == [FAST_MODEL]
+    assert result["summary"] == "Тест."
+
+
+def test_refused_first_call_raises_budget_exceeded():
+    client = ScriptedProvider({})
+    with pytest.raises(LLMBudgetExceeded):
+        analyze(client, call_gate=lambda: False)
+    assert client.calls == []
+
+
+def _prime_hedging(tickets):
+    """Enough latency samples for a p95 of 10 ms, and `tickets` seen for the hedge cap."""
+    for _ in range(HEDGE_MIN_SAMPLES):
+        cascade_stats.record_call(FAST_MODEL, None, 0.01, ok=True)
+    for _ in range(tickets):
+        cascade_stats.count("tickets")
+
+
+def test_slow_primary_is_hedged_and_backup_wins():
+    _prime_hedging(tickets=100)
+    client = ScriptedProvider({FAST_MODEL: [(1.0, False, 0.9), (0, False, 0.9)]})
+    started = time.monotonic()
+    analyze(client, cascade={**CASCADE, "hedge": True})
+    assert time.monotonic() - started < 0.5
+    assert client.calls == [FAST_MODEL, FAST_MODEL]
+    assert (cascade_stats.hedges, cascade_stats.hedge_wins) == (1, 1)
+
+
+def test_hedges_are_capped_by_ratio_of_tickets():
+    _prime_hedging(tickets=0)   # 1 ticket x HEDGE_MAX_RATIO allows no duplicate
+    client = ScriptedProvider({FAST_MODEL: [(0.05, False, 0.9)]})
+    analyze(client, cascade={**CASCADE, "hedge": True})
+    assert client.calls == [FAST_MODEL]
+    assert cascade_stats.hedges == 0
+
+
+def test_hedge_needs_a_call_from_the_gate():
+    _prime_hedging(tickets=100)
+    client = ScriptedProvider({FAST_MODEL: [(0.05, False, 0.9)]})
+    grants = iter([True])
+    analyze(client, cascade={**CASCADE, "hedge": True}, call_gate=lambda: next(grants, False))
+    assert client.calls == [FAST_MODEL]
+    assert cascade_stats.hedges == 0